@@ -0,0 +1,432 @@
+import os
+import io
+import re
+import base64
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+from shell5 import ShellEm, VirtualFileSystem
+
+
+def generate_image(path, size_mb, files_per_folder=100, file_size=1024):
+    # Синтетический образ VFS: папки по files_per_folder текстовых файлов
+    line = "строка тестового файла\n"
+    body = (line * (file_size // len(line.encode('utf-8')) + 1))[:file_size // 2]
+    total = size_mb * 1024 * 1024
+    written = 0
+    folder = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs name="bench">\n')
+        while written < total:
+            f.write(f'<folder name="d{folder}">\n')
+            for i in range(files_per_folder):
+                f.write(f'<file name="f{i}.txt">{body}</file>\n')
+                written += file_size
+            f.write('</folder>\n')
+            folder += 1
+        f.write('</vfs>\n')
+    return path
+
+
+def generate_base64_image(path, size_mb, files_per_folder=100, file_size=64 * 1024):
+    # Образ из файлов с encoding="base64" размером около file_size каждый
+    line = "строка тестового файла в base64\n"
+    body = (line * (file_size // len(line.encode('utf-8')) + 1)).encode('utf-8')[:file_size]
+    encoded = base64.b64encode(body).decode('ascii')
+    total = size_mb * 1024 * 1024
+    written = 0
+    folder = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs name="base64">\n')
+        while written < total:
+            f.write(f'<folder name="d{folder}">\n')
+            for i in range(files_per_folder):
+                f.write(f'<file name="f{i}.bin" encoding="base64">{encoded}</file>\n')
+                written += len(encoded)
+            f.write('</folder>\n')
+            folder += 1
+        f.write('</vfs>\n')
+    return path
+
+
+def generate_deep_image(path, nodes, depth=50, fanout=4):
+    # Образ из цепочек вложенных папок глубиной depth, всего около nodes узлов
+    chains = max(1, nodes // (depth * (fanout + 1)))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs name="deep">\n')
+        for chain in range(chains):
+            for level in range(depth):
+                f.write(f'<folder name="c{chain}_l{level}">')
+                for i in range(fanout):
+                    f.write(f'<file name="f{i}.txt">x</file>')
+            f.write('</folder>' * depth + '\n')
+        f.write('</vfs>\n')
+    deepest = '/' + '/'.join(f'c{chains - 1}_l{level}' for level in range(depth)) + '/f0.txt'
+    return path, deepest
+
+
+def generate_wide_image(path, nodes, files_per_folder=99):
+    # Образ примерно из nodes узлов: папки по files_per_folder коротких файлов
+    folders = max(1, nodes // (files_per_folder + 1))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs name="wide">\n')
+        for folder in range(folders):
+            f.write(f'<folder name="folder_{folder}">')
+            for i in range(files_per_folder):
+                f.write(f'<file name="file_{i}.txt">x</file>')
+            f.write('</folder>\n')
+        f.write('</vfs>\n')
+    return path
+
+
+def generate_text_image(path, files, files_per_folder=100):
+    # Образ из files коротких текстовых файлов с общим текстом и номером записи
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs name="text">\n')
+        for folder in range(max(1, files // files_per_folder)):
+            f.write(f'<folder name="d{folder}">\n')
+            for i in range(files_per_folder):
+                number = folder * files_per_folder + i
+                f.write(f'<file name="f{i}.txt">строка тестового файла\nномер записи {number}\n</file>\n')
+            f.write('</folder>\n')
+        f.write('</vfs>\n')
+    return path
+
+
+def make_shell(image_path, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        shell = ShellEm(vfs_path=image_path, **options)
+        shell.out.flush()
+    return shell
+
+
+def time_command(shell, command, repeat):
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            shell.execute_command(command, from_script=True)
+            shell.out.flush()
+            sink.seek(0)
+            sink.truncate()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat
+
+
+def bench_guard(args):
+    # Задержка команд с проверкой "VFS загружена" через get_info() и через vfs.loaded
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        shell = make_shell(image)
+        commands = ['ls', 'ls /d0', 'cd /d0', 'cat /d0/f0.txt', 'uniq /d0/f1.txt']
+
+        def legacy_guard():
+            # Проверка в прежнем виде: get_info() с хешированием всего образа
+            shell.vfs.mark_modified()
+            if not shell.vfs.get_info()['loaded']:
+                print("Ошибка: VFS не загружена")
+                return False
+            return True
+
+        print(f"Образ: {args.size_mb} МБ, повторов: {args.repeat}")
+        print(f"{'команда':<20}{'get_info(), мс':>18}{'vfs.loaded, мс':>18}")
+        for command in commands:
+            shell._require_vfs = legacy_guard
+            before = time_command(shell, command, args.repeat)
+            del shell._require_vfs
+            after = time_command(shell, command, args.repeat)
+            shell.current_path = "/"
+            print(f"{command:<20}{before * 1000:>18.3f}{after * 1000:>18.3f}")
+
+
+def bench_lookup(args):
+    # get_node для глубоких путей: индекс путей против обхода дерева
+    with tempfile.TemporaryDirectory() as tmp:
+        image, deepest = generate_deep_image(os.path.join(tmp, 'deep.xml'), args.nodes)
+        with contextlib.redirect_stdout(io.StringIO()):
+            vfs = VirtualFileSystem()
+            vfs.load_from_xml(image)
+        print(f"Узлов: {len(vfs.index)}, путь: {deepest.count('/')} уровней")
+        for use_index in (False, True):
+            vfs.use_index = use_index
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                vfs.get_node(deepest)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            mode = 'индекс' if use_index else 'обход дерева'
+            print(f"{mode:<15}{elapsed * 1e6:>10.2f} мкс")
+
+
+def time_load(image, **options):
+    vfs = VirtualFileSystem()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        vfs.load_from_xml(image, **options)
+        elapsed = time.perf_counter() - start
+    return elapsed, vfs
+
+
+def bench_snapshot(args):
+    # Запуск из XML против запуска из двоичного снимка
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        snapshot = os.path.join(tmp, 'bench.snap')
+        print(f"Образ: {args.size_mb} МБ")
+        for mode in ('stream', 'mmap'):
+            elapsed, _ = time_load(image, mode=mode)
+            print(f"{'XML, ' + mode:<28}{elapsed:>10.3f} с")
+        elapsed, _ = time_load(image, snapshot_path=snapshot)
+        print(f"{'XML + запись снимка':<28}{elapsed:>10.3f} с")
+        elapsed, vfs = time_load(image, snapshot_path=snapshot)
+        print(f"{'снимок (mmap)':<28}{elapsed:>10.3f} с")
+        print(f"{'  из них SHA-256 XML':<28}{time_hash(vfs, image):>10.3f} с")
+
+
+def time_hash(vfs, image):
+    start = time.perf_counter()
+    for _ in vfs._read_source(image):
+        pass
+    return time.perf_counter() - start
+
+
+def bench_memory(args):
+    # Память на узел дерева VFS после загрузки (tracemalloc)
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_wide_image(os.path.join(tmp, 'wide.xml'), args.nodes)
+        for use_index in (True, False):
+            tracemalloc.start()
+            vfs = VirtualFileSystem(use_index=use_index)
+            with contextlib.redirect_stdout(io.StringIO()):
+                vfs.load_from_xml(image)
+            used, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            mode = 'с индексом путей' if use_index else 'без индекса'
+            print(f"{mode:<20}{used / args.nodes:>10.1f} байт/узел ({used / 2 ** 20:.1f} МБ)")
+            del vfs
+
+
+def bench_cp(args):
+    # cp -r папки из образа в режиме mmap: время и память, добавленные копией
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb, files_per_folder=args.nodes)
+        shell = make_shell(image, vfs_mode='mmap')
+        source = shell.vfs.get_node('/d0')
+        size = sum(len(node.raw_view()) for node in source.children.values())
+        print(f"Папка /d0: {len(source.children)} файлов, {size / 2 ** 20:.1f} МБ содержимого")
+        elapsed = min(time_command(shell, f'cp -r /d0 /copy{i}', 1) for i in range(args.repeat))
+        tracemalloc.start()
+        time_command(shell, 'cp -r /d0 /traced', 1)
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"cp -r: {elapsed * 1000:.3f} мс, {elapsed * 1e6 / len(source.children):.2f} мкс/файл, "
+              f"память {used / 2 ** 20:.1f} МБ")
+
+
+def bench_dedup(args):
+    # Память после загрузки образа с одинаковым содержимым файлов: с дедупликацией и без
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        print(f"Образ: {args.size_mb} МБ")
+        for dedup in (False, True):
+            tracemalloc.start()
+            elapsed, vfs = time_load(image, dedup=dedup)
+            used, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            mode = 'с дедупликацией' if dedup else 'без дедупликации'
+            print(f"{mode:<20}{used / 2 ** 20:>10.1f} МБ{elapsed:>10.3f} с"
+                  f"  (сэкономлено {vfs.dedup_saved / 2 ** 20:.1f} МБ)")
+            del vfs
+
+
+def bench_decode(args):
+    # Загрузка образа из base64-файлов: декодирование по ходу разбора
+    # и в пуле из 1..workers процессов
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_base64_image(os.path.join(tmp, 'base64.xml'), args.size_mb)
+        print(f"Образ: {args.size_mb} МБ base64, процессоров: {os.cpu_count()}")
+        elapsed, _ = time_load(image)
+        print(f"{'без пула':<15}{elapsed:>10.3f} с")
+        for workers in range(1, args.workers + 1):
+            elapsed, _ = time_load(image, decode_workers=workers)
+            print(f"{f'процессов: {workers}':<15}{elapsed:>10.3f} с")
+
+
+def generate_script(path, lines):
+    # Скрипт из lines команд, работающих с образом generate_wide_image
+    commands = ['cd /folder_1', 'cat file_0.txt', 'cd ..', 'ls /', 'uname', 'cat "/folder_0/file_1.txt"']
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            f.write(commands[i % len(commands)] + '\n')
+    return path
+
+
+def legacy_run_script(shell):
+    # Выполнение скрипта в прежнем виде: строка за строкой через execute_command
+    with open(shell.script_path, 'r', encoding='utf-8') as file:
+        commands = file.readlines()
+    for line_num, command_line in enumerate(commands, 1):
+        command_line = command_line.strip()
+        if not command_line or command_line.startswith('#'):
+            continue
+        shell._print(f"{shell.user}@{shell.hostname}:{shell._get_display_path()}$ {command_line}")
+        if not shell.execute_command(command_line, from_script=True):
+            break
+
+
+def bench_script(args):
+    # Команд в секунду при выполнении скрипта: построчно, по заранее
+    # разобранному плану и по плану без вывода приглашений
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_wide_image(os.path.join(tmp, 'wide.xml'), 1000)
+        script = generate_script(os.path.join(tmp, 'script.txt'), args.lines)
+        print(f"Скрипт: {args.lines} команд")
+        runs = [('построчно', legacy_run_script, False),
+                ('план', ShellEm.run_script, False),
+                ('план, --quiet', ShellEm.run_script, True)]
+        for title, run, quiet in runs:
+            with contextlib.redirect_stdout(io.StringIO()):
+                shell = ShellEm(vfs_path=image, script_path=script, quiet=quiet, output=io.StringIO())
+            start = time.perf_counter()
+            run(shell)
+            shell.out.flush()
+            elapsed = time.perf_counter() - start
+            print(f"{title:<16}{args.lines / elapsed:>12.0f} команд/с")
+
+
+def bench_journal(args):
+    # Сохранение одного cp: запись в журнал против записи всего образа (compact)
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        journal = os.path.join(tmp, 'bench.journal')
+        shell = make_shell(image, vfs_mode='mmap', journal_path=journal)
+        size = os.path.getsize(journal)
+        elapsed = time_command(shell, 'cp /d0/f0.txt /d1/copy.txt', 1)
+        print(f"Образ: {os.path.getsize(image) / 2 ** 20:.1f} МБ")
+        print(f"{'cp с журналом':<20}{elapsed * 1000:>10.3f} мс, журнал +{os.path.getsize(journal) - size} байт")
+        elapsed, _ = time_load(image, mode='mmap', journal_path=journal)
+        print(f"{'загрузка с журналом':<20}{elapsed * 1000:>10.3f} мс")
+        elapsed = time_command(shell, 'vfs-compact', 1)
+        print(f"{'vfs-compact':<20}{elapsed * 1000:>10.3f} мс, образ {os.path.getsize(image) / 2 ** 20:.1f} МБ")
+
+
+def bench_merkle(args):
+    # Хеш Меркла: полный подсчет, пересчет после одного cp и vfs-diff с исходным образом
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        shell = make_shell(image, vfs_mode='mmap')
+        vfs = shell.vfs
+        print(f"Образ: {args.size_mb} МБ, узлов: {len(vfs.index)}")
+        start = time.perf_counter()
+        vfs.merkle_root
+        print(f"{'полный подсчет':<24}{(time.perf_counter() - start) * 1000:>10.3f} мс")
+        time_command(shell, 'cp /d0/f0.txt /d1/copy.txt', 1)
+        start = time.perf_counter()
+        vfs.merkle_root
+        print(f"{'пересчет после cp':<24}{(time.perf_counter() - start) * 1000:>10.3f} мс")
+        other = VirtualFileSystem(use_index=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            other.load_from_xml(image, mode='mmap')
+        other.merkle_root
+        start = time.perf_counter()
+        changes = list(vfs.diff(other))
+        print(f"{'diff (хеши готовы)':<24}{(time.perf_counter() - start) * 1000:>10.3f} мс, различий: {len(changes)}")
+
+
+def bench_find(args):
+    # find -name по индексу имен против обхода дерева
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_wide_image(os.path.join(tmp, 'wide.xml'), args.nodes)
+        shell = make_shell(image)
+        print(f"Узлов: {len(shell.vfs.index)}, повторов: {args.repeat}")
+        commands = ['find / -name folder_7', 'find / -name "file_1?.txt" -type f', 'find /folder_3 -name file_5.txt']
+        print(f"{'команда':<40}{'обход, мс':>12}{'индекс, мс':>12}")
+        for command in commands:
+            shell.vfs.use_index = False
+            before = time_command(shell, command, args.repeat)
+            shell.vfs.use_index = True
+            after = time_command(shell, command, args.repeat)
+            print(f"{command:<40}{before * 1000:>12.3f}{after * 1000:>12.3f}")
+
+
+def bench_grep(args):
+    # grep -r по всему образу: с повторной компиляцией шаблона, с кешем и в пуле процессов
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_image(os.path.join(tmp, 'bench.xml'), args.size_mb)
+        shell = make_shell(image, vfs_mode='mmap')
+        command = 'grep -rc "тест[а-я]+ файл" /d0'
+        print(f"Образ: {args.size_mb} МБ, повторов: {args.repeat}")
+        compile_regex = shell._compile_regex
+        shell._compile_regex = lambda pattern, flags: re.compile(pattern, flags)
+        re.purge()
+        print(f"{'без кеша шаблона':<24}{time_command(shell, command, args.repeat) * 1000:>10.3f} мс")
+        shell._compile_regex = compile_regex
+        print(f"{'кеш шаблона':<24}{time_command(shell, command, args.repeat) * 1000:>10.3f} мс")
+        command = 'grep -rc "тест[а-я]+ файл" /'
+        print(f"{'весь образ, 1 процесс':<24}{time_command(shell, command, 1) * 1000:>10.3f} мс")
+        workers = 2
+        while workers <= args.workers:
+            shell.grep_workers = workers
+            print(f"{f'весь образ, {workers} проц.':<24}{time_command(shell, command, 1) * 1000:>10.3f} мс")
+            shell._grep_pool.shutdown()
+            shell._grep_pool = None
+            workers *= 2
+
+
+def bench_trigram(args):
+    # grep -r по образу из --files файлов без индекса, первый поиск с построением
+    # триграммного индекса и последующие поиски по готовому индексу
+    with tempfile.TemporaryDirectory() as tmp:
+        image = generate_text_image(os.path.join(tmp, 'text.xml'), args.files)
+        shell = make_shell(image, trigram_index=True)
+        print(f"Файлов: {args.files}, повторов: {args.repeat}")
+        commands = ['grep -r "записи 4242$" /', 'grep -r "отсутствует" /', 'grep -rc "тестового" /d7']
+        shell.vfs.trigram_index = False
+        before = [time_command(shell, command, args.repeat) for command in commands]
+        shell.vfs.trigram_index = True
+        start = time.perf_counter()
+        shell.vfs._update_trigrams()
+        print(f"построение индекса: {(time.perf_counter() - start) * 1000:.3f} мс, "
+              f"триграмм: {len(shell.vfs.trigrams)}")
+        print(f"{'команда':<32}{'без индекса, мс':>18}{'с индексом, мс':>18}")
+        for command, elapsed in zip(commands, before):
+            after = time_command(shell, command, args.repeat)
+            print(f"{command:<32}{elapsed * 1000:>18.3f}{after * 1000:>18.3f}")
+
+
+BENCHMARKS = {
+    'cp': bench_cp,
+    'decode': bench_decode,
+    'dedup': bench_dedup,
+    'find': bench_find,
+    'grep': bench_grep,
+    'guard': bench_guard,
+    'journal': bench_journal,
+    'lookup': bench_lookup,
+    'memory': bench_memory,
+    'merkle': bench_merkle,
+    'script': bench_script,
+    'snapshot': bench_snapshot,
+    'trigram': bench_trigram,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки эмулятора командной строки')
+    parser.add_argument('name', choices=sorted(BENCHMARKS), help='Имя бенчмарка')
+    parser.add_argument('--size-mb', type=int, default=100, help='Размер синтетического образа, МБ')
+    parser.add_argument('--repeat', type=int, default=20, help='Число повторов каждой команды')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Наибольшее число процессов в бенчмарках decode и grep')
+    parser.add_argument('--lines', type=int, default=1000000, help='Число команд в скрипте')
+    parser.add_argument('--files', type=int, default=100000, help='Число файлов в бенчмарке trigram')
+    parser.add_argument('--nodes', type=int, default=200000, help='Число узлов синтетического дерева')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
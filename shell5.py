@@ -1,106 +1,1591 @@
 import os
 import sys
 import socket
+import re
+import fnmatch
 import shlex
 import argparse
+import getpass
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
 import hashlib
+import json
 import base64
+import codecs
+import mmap
+import struct
 import calendar
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+# Размер блока при потоковом чтении образа VFS
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Двоичный снимок VFS: заголовок, область содержимого файлов (UTF-8),
+# таблица узлов в порядке обхода (родитель раньше детей) и таблица строк
+SNAPSHOT_MAGIC = b'VFSSNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8s32sIIQQQ')  # сигнатура, SHA-256 XML, узлов, строк,
+                                                # смещения узлов, строк и содержимого
+SNAPSHOT_NODE = struct.Struct('<BIIIQQ')        # тип, родитель, имя, кодировка, смещение, длина
+SNAPSHOT_STRING = struct.Struct('<I')
+SNAPSHOT_FOLDER, SNAPSHOT_FILE = 0, 1
+
+# Символы, недопустимые в тексте XML 1.0: файлы с ними записываются в образ в base64
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+# Число запоминаемых результатов нормализации путей (ShellEm._normalize_path)
+PATH_CACHE_SIZE = 1024
+
+# Число скомпилированных регулярных выражений grep, которые держатся в кеше
+REGEX_CACHE_SIZE = 64
+# Примерный объем содержимого (в символах) в одной пачке файлов для пула grep
+GREP_BATCH_SIZE = 4 * 1024 * 1024
+
+# Символы, которые re.IGNORECASE считает равными, хотя их lower() различается
+# (как в re._casefix); в триграммном индексе каждый класс сводится к первому символу
+CASE_FOLD_CLASSES = ('i\u0131', 's\u017f', '\u00b5\u03bc', '\u0345\u03b9\u1fbe', '\u0390\u1fd3',
+                     '\u03b0\u1fe3', '\u03b2\u03d0', '\u03b5\u03f5', '\u03b8\u03d1', '\u03ba\u03f0',
+                     '\u03c0\u03d6', '\u03c1\u03f1', '\u03c3\u03c2', '\u03c6\u03d5', '\u0432\u1c80',
+                     '\u0434\u1c81', '\u043e\u1c82', '\u0441\u1c83', '\u0442\u1c84\u1c85',
+                     '\u044a\u1c86', '\u0463\u1c87', '\ua64b\u1c88', '\u1e61\u1e9b', '\ufb05\ufb06')
+# Счетный квантификатор {m}, {m,}, {,n}, {m,n}; остальные { и } в шаблоне - обычные символы
+REGEX_QUANTIFIER = re.compile(r'\{(?:[0-9]+(?:,[0-9]*)?|,[0-9]*)\}')
+CASE_FOLD_TABLE = {ord(c): group[0] for group in CASE_FOLD_CLASSES for c in group[1:]}
+
+# Символы, при которых строку команды нужно разбирать shlex: кавычки, экранирование
+# и пробельные символы, которые str.split() считает разделителями, а shlex - нет
+SHLEX_SPECIAL = re.compile('[\'"\\\\\x0b\x0c\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]')
+
+
+def join_path(folder_path, name):
+    # Путь узла по пути его папки: одна конкатенация вместо os.path.join
+    if folder_path.endswith('/'):
+        return folder_path + name
+    return folder_path + '/' + name
+
+
+def same_file(path, other):
+    # Один и тот же файл на диске, даже если пути записаны по-разному
+    # (относительный и абсолютный, через символическую ссылку)
+    if other is None:
+        return False
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return os.path.normcase(os.path.realpath(path)) == os.path.normcase(os.path.realpath(other))
+
 
 class VFSNode:
-    def __init__(self, name, path):
+    # __slots__ убирает у каждого узла __dict__. Полный путь не хранится,
+    # а собирается по ссылкам на родителя, имена интернируются загрузчиком.
+    # _hash - хеш узла в дереве Меркла (VirtualFileSystem.node_hash), None - не посчитан.
+    # Если хеш узла посчитан, посчитаны и хеши всех его потомков.
+    __slots__ = ('name', 'parent', '_hash')
+
+    def __init__(self, name):
         self.name = name
-        self.path = path
+        self.parent = None
+        self._hash = None
+
+    @property
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    def invalidate_hash(self):
+        # Сбрасывает хеши узла и его предков до корня; выше первого
+        # несосчитанного узла хешей уже нет
+        node = self
+        while node is not None and node._hash is not None:
+            node._hash = None
+            node = node.parent
+
+
+class Blob:
+    # Содержимое, общее для нескольких файлов: cp не копирует текст, а только
+    # увеличивает refs. Запись в файл освобождает его ссылку и дает файлу
+    # собственное содержимое (копирование при записи), остальные копии не меняются.
+    # digest - SHA-256 содержимого, если блок лежит в хранилище VirtualFileSystem.blobs.
+    __slots__ = ('data', 'refs', 'digest')
+
+    def __init__(self, data, digest=None):
+        self.data = data  # str или LazyContent
+        self.refs = 1
+        self.digest = digest
 
 
 class VFSFile(VFSNode):
+    __slots__ = ('_content', 'encoding')
 
-    def __init__(self, name, path, content="", encoding="text"):
-        super().__init__(name, path)
-        self.content = content
+    def __init__(self, name, content="", encoding="text"):
+        super().__init__(name)
+        self._content = content  # str, LazyContent или Blob
         self.encoding = encoding
-        self.size = len(content)
+
+    def _data(self):
+        content = self._content
+        if isinstance(content, Blob):
+            return content.data
+        return content
+
+    @property
+    def content(self):
+        content = self._data()
+        if isinstance(content, LazyContent):
+            return content.load(self.name)
+        return content
+
+    def release(self):
+        # Отдает ссылку на общее содержимое. Возвращает блок, если ссылок
+        # на него больше не осталось, иначе None.
+        blob = self._content
+        self._content = ""
+        if isinstance(blob, Blob):
+            blob.refs -= 1
+            if blob.refs == 0:
+                return blob
+        return None
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    def length_hint(self):
+        # Примерный размер содержимого без чтения: для еще не прочитанного
+        # содержимого - длина его фрагмента в образе
+        content = self._data()
+        if isinstance(content, LazyContent):
+            return content.length
+        return len(content)
+
+    def raw_view(self):
+        # Байты содержимого прямо из отображенного в память образа (без копирования)
+        # или None, если содержимое нужно декодировать
+        content = self._data()
+        if isinstance(content, LazyContent):
+            return content.view()
+        return None
+
+    def location(self):
+        # (путь образа, смещение, длина), если содержимое можно прочитать прямо
+        # из отображенного образа в другом процессе, иначе None
+        content = self._data()
+        if isinstance(content, LazyContent) and content.view() is not None:
+            return content.source.path, content.offset, content.length
+        return None
+
+    def iter_chunks(self, size=READ_CHUNK_SIZE):
+        # Содержимое блоками, не собирая его целиком, если позволяет хранилище
+        content = self._data()
+        if isinstance(content, LazyContent):
+            yield from content.iter_chunks(size, self.name)
+        else:
+            for start in range(0, len(content), size):
+                yield content[start:start + size]
+
+    def iter_lines(self):
+        # Строки содержимого по одной - то же, что content.split('\n'), но без списка всех строк
+        tail = ''
+        for chunk in self.iter_chunks():
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            yield from lines
+        yield tail
+
+    def copy_as(self, name):
+        # Копия файла, разделяющая содержимое (в том числе еще не прочитанное):
+        # при первой копии содержимое переносится в Blob, дальше растет только refs
+        blob = self._content
+        if isinstance(blob, Blob):
+            blob.refs += 1
+        else:
+            blob = self._content = Blob(blob)
+            blob.refs = 2
+        copy = VFSFile(name, blob, self.encoding)
+        copy._hash = self._hash
+        return copy
 
 
 class VFSFolder(VFSNode):
+    __slots__ = ('children',)
 
-    def __init__(self, name, path):
-        super().__init__(name, path)
+    def __init__(self, name):
+        super().__init__(name)
         self.children = {}  # name -> VFSNode
 
+    def copy_as(self, name):
+        # Копия поддерева: папки и файлы создаются заново (у каждого узла свой
+        # родитель), а содержимое файлов разделяется через Blob без чтения и копирования
+        # Хеш папки не зависит от ее имени, поэтому копии достаются посчитанные хеши
+        copy = VFSFolder(name)
+        copy._hash = self._hash
+        stack = [(self, copy)]
+        while stack:
+            source, target = stack.pop()
+            for child_name, child in source.children.items():
+                if isinstance(child, VFSFolder):
+                    child_copy = VFSFolder(child_name)
+                    child_copy._hash = child._hash
+                    stack.append((child, child_copy))
+                else:
+                    child_copy = child.copy_as(child_name)
+                child_copy.parent = target
+                target.children[child_name] = child_copy
+        return copy
+
+
+def decode_content(content, encoding, file_name, log=print):
+    # Декодирует base64-содержимое файла; при ошибке оставляет текст как есть
+    if encoding == 'base64' and content:
+        try:
+            content = base64.b64decode(content).decode('utf-8')
+        except Exception as e:
+            log(f"Ошибка декодирования base64 файла {file_name}: {e}")
+    return content
+
+
+def decode_base64_batch(payloads):
+    # Выполняется в рабочем процессе DecodePool: для каждого содержимого
+    # возвращает (текст, None) или (исходный текст, сообщение об ошибке)
+    results = []
+    for payload in payloads:
+        try:
+            results.append((base64.b64decode(payload).decode('utf-8'), None))
+        except Exception as e:
+            results.append((payload, str(e)))
+    return results
+
+
+def grep_lines(regex, lines):
+    # Номера и текст строк, в которых есть совпадение. Пустой хвост после
+    # завершающего \n строкой не считается, как в grep.
+    number = 0
+    previous = None
+    for line in lines:
+        if previous is not None:
+            number += 1
+            if regex.search(previous):
+                yield number, previous
+        previous = line
+    if previous:
+        number += 1
+        if regex.search(previous):
+            yield number, previous
+
+
+def fold_case(text):
+    # Посимвольное приведение регистра, согласованное с re.IGNORECASE: длина
+    # текста не меняется (в отличие от casefold() и lower() для 'İ'), а символы,
+    # равные для re без учета регистра, приводятся к одному
+    return text.replace('\u0130', 'i').lower().translate(CASE_FOLD_TABLE)
+
+
+def regex_trigrams(regex):
+    # Триграммы, которые обязательно есть (после fold_case) в любой строке с совпадением.
+    # Берутся только из литералов верхнего уровня шаблона; все остальное
+    # (классы, группы, метасимволы, литерал под * ? {m,n}) разрывает литерал.
+    # None - шаблон сузить нельзя: | на верхнем уровне или re.VERBOSE.
+    if regex.flags & re.VERBOSE:
+        return None
+    pattern = regex.pattern
+    runs = []
+    run = []
+    depth = 0
+    i = 0
+    n = len(pattern)
+
+    def optional(pos):
+        # Следующий за литералом квантификатор допускает ноль повторений (или больше одного)
+        return pos < n and (pattern[pos] in '*?' or REGEX_QUANTIFIER.match(pattern, pos) is not None)
+
+    while i < n:
+        c = pattern[i]
+        i += 1
+        literal = None
+        if c == '\\':
+            if i >= n:
+                break
+            c = pattern[i]
+            i += 1
+            if not (c.isascii() and c.isalnum()):
+                literal = c
+            elif c in 'xuU':
+                i += {'x': 2, 'u': 4, 'U': 8}[c]
+            elif c == 'N':
+                end = pattern.find('}', i)
+                i = n if end < 0 else end + 1
+            elif c.isdigit():
+                while i < n and pattern[i].isdigit():
+                    i += 1
+        elif c == '[':
+            if i < n and pattern[i] == '^':
+                i += 1
+            if i < n and pattern[i] == ']':
+                i += 1
+            while i < n and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|':
+            if depth == 0:
+                return None
+        elif c == '{':
+            quantifier = REGEX_QUANTIFIER.match(pattern, i - 1)
+            if quantifier is not None:
+                i = quantifier.end()
+            else:
+                literal = c
+        elif c not in '.^$*+?':
+            literal = c
+
+        # Литерал под квантификатором * ? {m,n} может отсутствовать в совпадении,
+        # после + он есть, но за ним может повториться - литерал на нем заканчивается
+        if literal is not None and depth == 0 and not optional(i):
+            run.append(literal)
+            if not (i < n and pattern[i] == '+'):
+                continue
+        if run:
+            runs.append(''.join(run))
+            run = []
+    if run:
+        runs.append(''.join(run))
+
+    grams = set()
+    for text in runs:
+        text = fold_case(text)
+        grams.update(text[j:j + 3] for j in range(len(text) - 2))
+    return grams
+
+
+def grep_batch(pattern, flags, items, count_only):
+    # Выполняется в рабочем процессе grep: items - текст файла или (путь образа,
+    # смещение, длина) для чтения из отображенного образа без передачи содержимого
+    regex = re.compile(pattern, flags)
+    maps = {}
+    results = []
+    try:
+        for item in items:
+            if isinstance(item, str):
+                text = item
+            else:
+                path, offset, length = item
+                if path not in maps:
+                    with open(path, 'rb') as f:
+                        maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                text = str(maps[path][offset:offset + length], 'utf-8')
+            matches = grep_lines(regex, VFSFile("", text).iter_lines())
+            results.append(sum(1 for _ in matches) if count_only else list(matches))
+    finally:
+        for image in maps.values():
+            image.close()
+    return results
+
+
+class DecodePool:
+    # Параллельное декодирование base64 при загрузке: содержимое копится
+    # пачками примерно по batch_size символов и отправляется в пул процессов.
+    # results() отдает пары (файл, результат) в исходном порядке файлов.
+
+    def __init__(self, workers, batch_size=4 * 1024 * 1024):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.batch_size = batch_size
+        self.files = []
+        self.payloads = []
+        self.size = 0
+        self.pending = []  # (файлы пачки, future)
+
+    def add(self, node, payload):
+        self.files.append(node)
+        self.payloads.append(payload)
+        self.size += len(payload)
+        if self.size >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if self.payloads:
+            future = self.executor.submit(decode_base64_batch, self.payloads)
+            self.pending.append((self.files, future))
+            self.files = []
+            self.payloads = []
+            self.size = 0
+
+    def results(self):
+        self._submit()
+        for files, future in self.pending:
+            yield from zip(files, future.result())
+        self.pending.clear()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class OutputSink:
+    # Буферизованный вывод команд: текст копится в списке и уходит в поток
+    # крупными блоками. stream=None - текущий sys.stdout, для тестов можно
+    # передать io.StringIO. flush() нужно вызывать перед ожиданием ввода.
+
+    def __init__(self, stream=None, buffer_size=64 * 1024):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def _target(self):
+        return self.stream if self.stream is not None else sys.stdout
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self._drain()
+
+    def write_bytes(self, data):
+        # Готовые байты UTF-8 (срез отображенного образа) пишутся в двоичный
+        # поток без декодирования, если он есть и ожидает UTF-8
+        target = self._target()
+        if not self._accepts_utf8(target):
+            self.write(str(data, 'utf-8'))
+            return
+        self._drain()
+        target.flush()
+        target.buffer.write(data)
+
+    @staticmethod
+    def _accepts_utf8(target):
+        encoding = getattr(target, 'encoding', None)
+        if not encoding or not hasattr(target, 'buffer'):
+            return False
+        return codecs.lookup(encoding).name == 'utf-8'
+
+    def _drain(self):
+        if self.parts:
+            self._target().write(''.join(self.parts))
+            self.parts.clear()
+            self.size = 0
+
+    def flush(self):
+        self._drain()
+        self._target().flush()
+
+
+class ImageSource:
+    # Исходный образ VFS на диске для ленивого режима: содержимое файлов
+    # читается из него по смещениям. cache_size=None - прочитанный текст
+    # остается у файла, иначе держим не более cache_size последних (LRU).
+
+    def __init__(self, path, cache_size=None, log=print):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.log = log
+
+    def read(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def read_blocks(self, offset, length, size):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(size, length))
+                if not block:
+                    break
+                length -= len(block)
+                yield block
+
+    def has_markup(self, raw, offset, length):
+        # raw=None - проверить фрагмент по блокам, не читая его целиком
+        if raw is None:
+            return any(self.has_markup(block, 0, 0)
+                       for block in self.read_blocks(offset, length, READ_CHUNK_SIZE))
+        return b'<' in raw or b'&' in raw or b'\r' in raw
+
+    def text(self, offset, length):
+        # Текст элемента из сырого фрагмента образа. Фрагмент без разметки,
+        # сущностей и \r просто декодируется, иначе его разбирает парсер XML.
+        raw = self.read(offset, length)
+        if self.has_markup(raw, offset, length):
+            return ET.fromstring(b'<file>' + bytes(raw) + b'</file>').text or ""
+        return str(raw, 'utf-8')
+
+    def view(self, offset, length):
+        return None
+
+    def iter_text(self, offset, length, size):
+        # Текст фрагмента блоками по size байт или None, если фрагмент
+        # нужно целиком разбирать как XML
+        if self.has_markup(None, offset, length):
+            return None
+        return self._decode_blocks(offset, length, size)
+
+    def _decode_blocks(self, offset, length, size):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for block in self.read_blocks(offset, length, size):
+            text = decoder.decode(block)
+            if text:
+                yield text
+        text = decoder.decode(b'', True)
+        if text:
+            yield text
+
+
+class MappedImage(ImageSource):
+    # Образ, отображенный в память: фрагменты читаются срезами memoryview
+    # без копирования, а страницы образа делят все процессы, открывшие его.
+
+    def __init__(self, path, cache_size=None, log=print):
+        super().__init__(path, cache_size, log)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.map)
+
+    def close(self):
+        # Пока образ отображен, файл нельзя заменить (на Windows os.replace
+        # завершится ошибкой); после close файлы, читающие из образа, недоступны
+        self.buffer.release()
+        self.map.close()
+
+    def read(self, offset, length):
+        return self.buffer[offset:offset + length]
+
+    def read_blocks(self, offset, length, size):
+        end = offset + length
+        for start in range(offset, end, size):
+            yield self.buffer[start:min(start + size, end)]
+
+    def has_markup(self, raw, offset, length):
+        end = offset + length
+        return (self.map.find(b'<', offset, end) != -1 or self.map.find(b'&', offset, end) != -1
+                or self.map.find(b'\r', offset, end) != -1)
+
+    def view(self, offset, length):
+        raw = self.read(offset, length)
+        if self.has_markup(raw, offset, length):
+            return None
+        return raw
+
+
+class SnapshotImage(MappedImage):
+    # Отображенный в память снимок VFS: содержимое в нем уже декодировано
+    # и хранится как есть, разбирать его как XML не нужно
+
+    def has_markup(self, raw, offset, length):
+        return False
+
+
+class LazyContent:
+    # Содержимое файла, которое еще не прочитано из образа:
+    # хранятся только смещение и длина текста элемента <file>
+    __slots__ = ('source', 'offset', 'length', 'encoding', 'text')
+
+    def __init__(self, source, offset, length, encoding):
+        # encoding - кодировка самого фрагмента: 'base64' декодируется при чтении
+        self.source = source
+        self.offset = offset
+        self.length = length
+        self.encoding = encoding
+        self.text = None
+
+    def load(self, file_name, keep=True):
+        # keep=False - не оставлять текст у файла (для чтения блоками), LRU-кеш
+        # при этом работает как обычно
+        if self.text is not None:
+            return self.text
+
+        cache = self.source.cache
+        text = cache.get(self.offset)
+        if text is not None:
+            cache.move_to_end(self.offset)
+            return text
+
+        text = decode_content(self.source.text(self.offset, self.length), self.encoding,
+                              file_name, self.source.log)
+        cache_size = self.source.cache_size
+        if cache_size is None:
+            if keep:
+                self.text = text
+        elif cache_size > 0:
+            cache[self.offset] = text
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+        return text
+
+    def view(self):
+        if self.encoding == 'base64':
+            return None
+        return self.source.view(self.offset, self.length)
+
+    def iter_chunks(self, size, file_name):
+        # Еще не декодированный текстовый фрагмент читается из образа блоками,
+        # не попадая в память целиком; иначе режем уже декодированный текст
+        if self.text is None and self.encoding != 'base64' and self.offset not in self.source.cache:
+            chunks = self.source.iter_text(self.offset, self.length, size)
+            if chunks is not None:
+                yield from chunks
+                return
+        text = self.load(file_name, keep=False)
+        for start in range(0, len(text), size):
+            yield text[start:start + size]
+
+
+class ResolvedPath:
+    # Результат однократного разрешения пути: нормализованный путь,
+    # найденный узел (None, если его нет) и родительская папка.
+    # Передается в операции VFS вместо строки, чтобы не искать узел повторно.
+    __slots__ = ('path', 'node', 'parent', 'name')
+
+    def __init__(self, path, node, parent, name):
+        self.path = path
+        self.node = node
+        self.parent = parent
+        self.name = name
+
+    @property
+    def parent_path(self):
+        return self.path.rsplit('/', 1)[0] or "/"
+
 
 class VirtualFileSystem:
 
-    def __init__(self):
-        self.root = VFSFolder("", "/")
+    def __init__(self, use_index=True):
+        self.root = VFSFolder("")
+        # Плоский индекс "абсолютный путь -> узел" для поиска за O(1).
+        # При use_index=False get_node обходит дерево, как раньше.
+        self.use_index = use_index
+        self.index = {"/": self.root}
+        # Обратный индекс имен "имя -> узел" (или множество узлов с этим именем)
+        # для find; ведется вместе с индексом путей
+        self.names = {}
+        # Хранилище записанного содержимого по SHA-256: одинаковый текст,
+        # записанный в разные файлы, хранится один раз (см. write_file)
+        self.blobs = {}
+        self.dedup = False         # дедупликация одинакового содержимого при загрузке
+        self.dedup_saved = 0       # сколько байт содержимого не пришлось хранить повторно
+        self._decoder = None       # DecodePool на время загрузки с decode_workers
+        self.journal_path = None   # журнал изменений дерева (см. _open_journal)
+        self._replaying = False    # идет воспроизведение журнала - не записывать его повторно
+        self._load_args = {}       # параметры загрузки для перезагрузки после compact
+        self._image = None         # отображенный в память образ или снимок текущего дерева
+        # Триграммный индекс содержимого для grep -r: "триграмма -> множество файлов".
+        # Строится при первом поиске (trigrams=None - еще не построен); измененные
+        # после этого файлы переиндексируются при следующем поиске.
+        self.trigram_index = False
+        self.trigrams = None
+        self._file_trigrams = {}   # файл -> его триграммы, чтобы убрать файл из индекса
+        self._trigram_stale = set()  # файлы, которые нужно (пере)индексировать
         self.name = ""
         self.raw_data = ""
-
-    def load_from_xml(self, xml_path):
+        self.source_path = None
+        self.loaded = False
+        self.log = print           # куда выводить сообщения загрузчика
+        self._sha256 = None        # кеш хеша образа
+        self._source_stamp = None  # (размер, mtime) исходного файла на момент хеширования
+
+    def load_from_xml(self, xml_path, mode="stream", cache_size=None, snapshot_path=None,
+                      dedup=False, decode_workers=None, journal_path=None, trigram_index=False):
+        # mode="stream" - потоковый разбор без построения XML-дерева,
+        # mode="lazy" - то же, но содержимое файлов читается из образа при первом обращении
+        #               (cache_size - размер LRU-кеша декодированного содержимого),
+        # mode="mmap" - как lazy, но образ отображается в память и читается без копирования,
+        # mode="tree" - прежний загрузчик через ElementTree (запасной вариант).
+        # snapshot_path - двоичный снимок VFS: если он сделан с этой же версии XML
+        # (совпадает SHA-256), дерево берется из него, иначе XML разбирается
+        # и снимок записывается заново.
+        # dedup=True - одинаковое декодированное содержимое файлов (по SHA-256)
+        # хранится один раз и разделяется через Blob, как после cp.
+        # decode_workers - число процессов для декодирования base64 в режимах
+        # stream и tree (None - декодировать по ходу разбора, как раньше).
+        # journal_path - журнал изменений (cp, rmdir, write_file): изменения
+        # дописываются в него по одному, а при загрузке применяются поверх XML.
+        # trigram_index=True - сужать grep -r триграммным индексом (см. grep_candidates).
+        self.loaded = False
+        self.journal_path = None
+        self._release_image()
+        self._load_args = {'mode': mode, 'cache_size': cache_size, 'snapshot_path': snapshot_path,
+                           'dedup': dedup, 'decode_workers': decode_workers,
+                           'journal_path': journal_path, 'trigram_index': trigram_index}
+        self.raw_data = ""
+        self._sha256 = None
         try:
-            with open(xml_path, 'r', encoding='utf-8') as f:
-                self.raw_data = f.read()
+            self.root = VFSFolder("")
+            self.index = {"/": self.root}
+            self.names = {}
+            self.blobs = {}
+            self.dedup = dedup
+            self.dedup_saved = 0
+            self.trigram_index = trigram_index
+            self.trigrams = None
+            self._file_trigrams = {}
+            self._trigram_stale = set()
+            save_snapshot = False
+            if snapshot_path is None:
+                self._load_mode(xml_path, mode, cache_size, decode_workers)
+            else:
+                for _ in self._read_source(xml_path):
+                    pass
+                if not self._load_snapshot(snapshot_path, self._sha256, cache_size):
+                    self._load_mode(xml_path, mode, cache_size, decode_workers)
+                    save_snapshot = True
+
+            self.source_path = xml_path
+            self.loaded = True
+            if save_snapshot:
+                self._save_snapshot(snapshot_path)
+            if journal_path is not None:
+                self._open_journal(journal_path)
+            self.log(f"VFS '{self.name}' успешно загружена из {xml_path}")
+            return True
 
-            tree = ET.ElementTree(ET.fromstring(self.raw_data))
-            root = tree.getroot()
+        except Exception as e:
+            self.log(f"Ошибка загрузки VFS: {e}")
+            return False
 
-            self.name = root.get('name', 'unnamed_vfs')
-            self.root = VFSFolder("", "/")
+    def _open_journal(self, journal_path):
+        # Журнал - текстовый файл из записей JSON по одной на строку. Первая запись
+        # хранит SHA-256 образа, к которому относятся изменения; журнал другой
+        # версии образа не применяется: он переименовывается в .old, и изменения
+        # этого сеанса пишутся в новый журнал.
+        if not os.path.exists(journal_path):
+            self._reset_journal(journal_path, self.sha256)
+            return
 
-            # Рекурсивно строим структуру VFS
-            self._parse_folder(root, self.root, "/")
+        with open(journal_path, 'rb') as f:
+            header = f.readline()
+            try:
+                base = json.loads(header).get('base') if header.endswith(b'\n') else None
+            except (ValueError, AttributeError):
+                base = None
+            if base != self.sha256:
+                os.replace(journal_path, journal_path + '.old')
+                self.log(f"Журнал {journal_path} относится к другой версии образа и не применяется; "
+                         f"он сохранен как {journal_path}.old, начат новый журнал")
+                self._reset_journal(journal_path, self.sha256)
+                return
+
+            applied = 0
+            complete = len(header)  # конец последней полностью записанной строки
+            self._replaying = True
+            try:
+                for line_num, line in enumerate(f, 2):
+                    if not line.endswith(b'\n'):
+                        break  # запись не дописана до конца (прерванная запись)
+                    complete += len(line)
+                    try:
+                        if self._replay(json.loads(line)):
+                            applied += 1
+                            continue
+                    except (ValueError, KeyError) as e:
+                        self.log(f"Журнал {journal_path}, строка {line_num}: {e}")
+                        continue
+                    self.log(f"Журнал {journal_path}, строка {line_num}: изменение не применено")
+            finally:
+                self._replaying = False
+
+        # Недописанная последняя запись отрезается, иначе следующая запись
+        # склеится с ней в одну испорченную строку
+        if os.path.getsize(journal_path) > complete:
+            os.truncate(journal_path, complete)
+            self.log(f"Журнал {journal_path}: отброшена недописанная последняя запись")
+        self.journal_path = journal_path
+        if applied:
+            self.log(f"Из журнала применено изменений: {applied}")
+
+    def _release_image(self):
+        # Закрывает отображение образа (или снимка) текущего дерева: после этого
+        # ленивые файлы дерева не читаются, поэтому только перед его заменой
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def _reset_journal(self, journal_path, sha256):
+        try:
+            with open(journal_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'base': sha256}) + '\n')
+            self.journal_path = journal_path
+        except OSError as e:
+            self.log(f"Не удалось создать журнал VFS: {e}")
+
+    def _journal(self, record):
+        # Дописывает одну запись: сохранение изменения стоит столько, сколько само изменение
+        if self.journal_path is None or self._replaying:
+            return
+        try:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            self.log(f"Не удалось записать изменение в журнал VFS: {e}")
+
+    def _replay(self, record):
+        op = record['op']
+        if op == 'write':
+            return self.write_file(record['path'], record['text'])
+
+        folder_path, _, name = record['path'].rpartition('/')
+        folder = self.get_node(folder_path or "/")
+        if not isinstance(folder, VFSFolder):
+            return False
+        if op == 'rm':
+            return self.remove_node(folder, name)
+        if op == 'cp':
+            source = self.get_node(record['src'])
+            if source is None or source is self.root:
+                return False
+            self.copy_node(source, folder, name)
+            return True
+        raise ValueError(f"неизвестная операция '{op}'")
+
+    def compact(self, xml_path=None):
+        # Записывает текущее дерево (образ с примененным журналом) в новый XML.
+        # Если образ записан на место исходного, журнал начинается заново,
+        # а VFS перезагружается из нового образа с прежними параметрами.
+        xml_path = xml_path or self.source_path
+        in_place = same_file(xml_path, self.source_path)
+        released = False
+        tmp_path = xml_path + '.tmp'
+        digest = hashlib.sha256()
+        try:
+            with open(tmp_path, 'wb') as f:
+                def emit(text):
+                    data = text.encode('utf-8')
+                    digest.update(data)
+                    f.write(data)
+
+                emit('<?xml version="1.0" encoding="UTF-8"?>\n')
+                emit(f'<vfs name={quoteattr(self.name)}>\n')
+                stack = [iter(self.root.children.values())]
+                while stack:
+                    node = next(stack[-1], None)
+                    if node is None:
+                        stack.pop()
+                        if stack:
+                            emit('</folder>\n')
+                    elif isinstance(node, VFSFolder):
+                        emit(f'<folder name={quoteattr(node.name)}>\n')
+                        stack.append(iter(node.children.values()))
+                    else:
+                        emit(self._file_element(node))
+                emit('</vfs>\n')
+            if in_place and self._image is not None:
+                # Отображение закрывается до замены образа: дерево все равно
+                # перезагружается из нового образа
+                self._release_image()
+                released = True
+            os.replace(tmp_path, xml_path)
+        except (OSError, UnicodeEncodeError) as e:
+            self.log(f"Не удалось записать образ VFS: {e}")
+            if released:
+                # Содержимое файлов читалось из закрытого отображения
+                self.load_from_xml(self.source_path, **self._load_args)
+            return False
 
-            print(f"VFS '{self.name}' успешно загружена из {xml_path}")
+        if not in_place:
             return True
+        journal_path = self.journal_path
+        if journal_path is not None:
+            self._reset_journal(journal_path, digest.hexdigest())
+        return self.load_from_xml(xml_path, **self._load_args)
+
+    @staticmethod
+    def _file_element(node):
+        text = node.content
+        name = quoteattr(node.name)
+        if node.encoding == 'base64' or XML_INVALID_CHARS.search(text):
+            data = base64.b64encode(text.encode('utf-8', 'surrogatepass')).decode('ascii')
+            return f'<file name={name} encoding="base64">{data}</file>\n'
+        # \r экранируется, иначе разбор XML превратит его в \n
+        return f'<file name={name}>{escape(text, {chr(13): "&#13;"})}</file>\n'
+
+    def _load_mode(self, xml_path, mode, cache_size, decode_workers=None):
+        if decode_workers and mode in ("stream", "tree"):
+            self._decoder = DecodePool(decode_workers)
+            try:
+                self._load_parsed(xml_path, mode, cache_size)
+                self._finish_decoding()
+            finally:
+                self._decoder.close()
+                self._decoder = None
+        else:
+            self._load_parsed(xml_path, mode, cache_size)
+
+    def _finish_decoding(self):
+        # Результаты пула присваиваются файлам, ошибки выводятся по каждому файлу
+        for node, (text, error) in self._decoder.results():
+            if error is not None:
+                self.log(f"Ошибка декодирования base64 файла {node.name}: {error}")
+            if self.dedup and text:
+                text = self._dedup_blob(text)
+            node._content = text
+
+    def _load_parsed(self, xml_path, mode, cache_size):
+        if mode == "stream":
+            self._load_stream(xml_path)
+        elif mode == "lazy":
+            self._load_stream(xml_path, ImageSource(xml_path, cache_size, self._log))
+        elif mode == "mmap":
+            self._image = MappedImage(xml_path, cache_size, self._log)
+            self._load_stream(xml_path, self._image)
+        elif mode == "tree":
+            self._load_tree(xml_path)
+        else:
+            raise ValueError(f"неизвестный режим загрузки '{mode}'")
+
+    def _save_snapshot(self, snapshot_path):
+        # Записывает двоичный снимок только что загруженного дерева. Снимок помечается
+        # SHA-256 исходного XML, по которому потом проверяется его актуальность.
+        strings = {}
+
+        def string_id(value):
+            if value not in strings:
+                strings[value] = len(strings)
+            return strings[value]
+
+        string_id(self.name)
+        nodes = bytearray()
+        blobs = {}  # общее содержимое (например, после cp) пишется один раз
+        tmp_path = snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(bytes(SNAPSHOT_HEADER.size))
+                blob_size = 0
+                count = 0
+                stack = [(self.root, 0)]
+                while stack:
+                    node, parent = stack.pop()
+                    index = count
+                    count += 1
+                    if isinstance(node, VFSFolder):
+                        nodes += SNAPSHOT_NODE.pack(SNAPSHOT_FOLDER, parent, string_id(node.name), 0, 0, 0)
+                        stack.extend((child, index) for child in reversed(list(node.children.values())))
+                        continue
+
+                    key = id(node._content)
+                    if key not in blobs:
+                        data = node.content.encode('utf-8')
+                        f.write(data)
+                        blobs[key] = (blob_size, len(data))
+                        blob_size += len(data)
+                    offset, length = blobs[key]
+                    nodes += SNAPSHOT_NODE.pack(SNAPSHOT_FILE, parent, string_id(node.name),
+                                                string_id(node.encoding), offset, length)
+
+                nodes_offset = SNAPSHOT_HEADER.size + blob_size
+                f.write(nodes)
+                strings_offset = nodes_offset + len(nodes)
+                for value in strings:
+                    data = value.encode('utf-8')
+                    f.write(SNAPSHOT_STRING.pack(len(data)))
+                    f.write(data)
+
+                f.seek(0)
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, bytes.fromhex(self.sha256), count,
+                                             len(strings), nodes_offset, strings_offset,
+                                             SNAPSHOT_HEADER.size))
+            os.replace(tmp_path, snapshot_path)
+            return True
+        except OSError as e:
+            self.log(f"Не удалось сохранить снимок VFS: {e}")
+            return False
 
-        except Exception as e:
-            print(f"Ошибка загрузки VFS: {e}")
+    def _load_snapshot(self, snapshot_path, sha256, cache_size=None):
+        # Возвращает False, если снимка нет, он сделан с другой версии XML или
+        # поврежден (например, обрезан): тогда загружается XML, а снимок
+        # записывается заново. Испорченный кеш не должен мешать загрузке.
+        if not os.path.exists(snapshot_path):
+            return False
+        source = None
+        try:
+            source = SnapshotImage(snapshot_path, cache_size, self._log)
+            if self._build_snapshot(source, sha256):
+                self._image = source
+                return True
+        except (ValueError, IndexError, TypeError, struct.error) as e:
+            self.root = VFSFolder("")
+            self.index = {"/": self.root}
+            self.names = {}
+            self.blobs = {}
+            self.dedup_saved = 0
+            self.log(f"Снимок VFS {snapshot_path} поврежден ({e}), загружается XML")
+        # Снимок будет записан заново, поэтому его отображение закрывается
+        if source is not None:
+            source.close()
+        return False
+
+    def _build_snapshot(self, source, sha256):
+        buffer = source.buffer
+        size = len(buffer)
+        if size < SNAPSHOT_HEADER.size:
+            return False
+        (magic, digest, node_count, string_count,
+         nodes_offset, strings_offset, blobs_offset) = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+        if magic != SNAPSHOT_MAGIC or digest.hex() != sha256:
             return False
+        if not (blobs_offset <= nodes_offset and nodes_offset + node_count * SNAPSHOT_NODE.size
+                <= strings_offset <= size) or not node_count or not string_count:
+            raise ValueError("неверный заголовок")
+
+        strings = []
+        pos = strings_offset
+        for _ in range(string_count):
+            (length,) = SNAPSHOT_STRING.unpack_from(buffer, pos)
+            pos += SNAPSHOT_STRING.size
+            if pos + length > size:
+                raise ValueError("таблица строк обрезана")
+            strings.append(str(buffer[pos:pos + length], 'utf-8'))
+            pos += length
+
+        self.name = strings[0]
+        blobs_size = nodes_offset - blobs_offset
+        shared = {}  # смещение -> Blob: одинаковое содержимое в снимке уже записано один раз
+        nodes = []  # (папка, путь) для каждого узла таблицы
+        node_table = buffer[nodes_offset:nodes_offset + node_count * SNAPSHOT_NODE.size]
+        for kind, parent, name_id, encoding_id, offset, length in SNAPSHOT_NODE.iter_unpack(node_table):
+            if not nodes:
+                if kind != SNAPSHOT_FOLDER:
+                    raise ValueError("корень не является папкой")
+                nodes.append((self.root, "/"))
+                continue
+            if parent >= len(nodes) or nodes[parent] is None:
+                raise ValueError("неверная ссылка на родителя")
+            if kind == SNAPSHOT_FOLDER:
+                nodes.append(self._add_folder(*nodes[parent], strings[name_id]))
+                continue
+            if offset + length > blobs_size:
+                raise ValueError("содержимое файла за пределами снимка")
+            if not length:
+                content = ""
+            elif not self.dedup:
+                content = LazyContent(source, blobs_offset + offset, length, 'text')
+            elif offset in shared:
+                content = shared[offset]
+                content.refs += 1
+                self.dedup_saved += length
+            else:
+                content = shared[offset] = Blob(LazyContent(source, blobs_offset + offset, length, 'text'))
+            self._add_file(*nodes[parent], strings[name_id], strings[encoding_id], content)
+            nodes.append(None)
+        return True
+
+    def _log(self, message):
+        # Для источников ленивого содержимого: сообщения идут в текущий self.log
+        self.log(message)
+
+    def _read_source(self, xml_path):
+        # Читает образ блоками и попутно считает SHA-256,
+        # чтобы не хешировать его повторно после загрузки
+        sha256 = hashlib.sha256()
+        stamp = self._stat_source(xml_path)
+        with open(xml_path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                yield chunk
+        self._sha256 = sha256.hexdigest()
+        self._source_stamp = stamp
+
+    @staticmethod
+    def _stat_source(xml_path):
+        st = os.stat(xml_path)
+        return st.st_size, st.st_mtime_ns
+
+    def _load_tree(self, xml_path):
+        self.raw_data = b''.join(self._read_source(xml_path)).decode('utf-8')
+
+        tree = ET.ElementTree(ET.fromstring(self.raw_data))
+        root = tree.getroot()
+
+        self.name = root.get('name', 'unnamed_vfs')
+
+        # Строим структуру VFS обходом XML-дерева
+        self._parse_folder(root, self.root, "/")
+
+    def _load_stream(self, xml_path, lazy_source=None):
+        # Файл читается блоками и скармливается expat. Узлы VFS создаются
+        # по событиям парсера, текст файла собирается только до закрытия
+        # его элемента, поэтому в памяти остается лишь само дерево VFS.
+        # С lazy_source текст не собирается вовсе: запоминаются смещения
+        # содержимого в образе (для них нужен buffer_text=False).
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = lazy_source is None
+
+        stack = []          # открытые элементы: (VFSFolder, путь) или None, если элемент не разбираем
+        file_parent = None  # (папка, путь), куда попадет текущий <file>
+        file_attrs = None
+        file_depth = 0
+        text_parts = []
+        text_closed = False
+        content_start = None  # смещение содержимого текущего <file> в образе
+
+        def mark_content_start(*args):
+            # Первое событие внутри <file> отмечает начало его содержимого
+            nonlocal content_start
+            if file_parent is not None and content_start is None:
+                content_start = parser.CurrentByteIndex
+                parser.CharacterDataHandler = None
+
+        def start_element(tag, attrs):
+            nonlocal file_parent, file_attrs, file_depth, text_closed, content_start
+            if not stack:
+                self.name = attrs.get('name', 'unnamed_vfs')
+                stack.append((self.root, "/"))
+                return
+
+            if file_parent is not None:
+                # Как и в ElementTree, содержимым файла считается текст до первого вложенного элемента
+                text_closed = True
+                if lazy_source is not None:
+                    mark_content_start()
+
+            parent = stack[-1]
+            node = None
+            if parent is not None and tag == 'folder':
+                node = self._add_folder(*parent, attrs.get('name', ''))
+            elif parent is not None and tag == 'file':
+                file_parent = parent
+                file_attrs = attrs
+                file_depth = len(stack) + 1
+                text_parts.clear()
+                text_closed = False
+                if lazy_source is not None:
+                    content_start = None
+                    parser.CharacterDataHandler = mark_content_start
+            stack.append(node)
+
+        def end_element(tag):
+            nonlocal file_parent, file_attrs
+            if file_parent is not None and len(stack) == file_depth:
+                encoding = file_attrs.get('encoding', 'text')
+                if lazy_source is None:
+                    content = ''.join(text_parts)
+                elif content_start is None:
+                    content = ""
+                    parser.CharacterDataHandler = None
+                else:
+                    content = LazyContent(lazy_source, content_start,
+                                          parser.CurrentByteIndex - content_start, encoding)
+                self._add_file(*file_parent, file_attrs.get('name', ''), encoding, content)
+                text_parts.clear()
+                file_parent = None
+                file_attrs = None
+            stack.pop()
+
+        def char_data(data):
+            if file_parent is not None and not text_closed:
+                text_parts.append(data)
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        if lazy_source is None:
+            parser.CharacterDataHandler = char_data
+        else:
+            parser.CommentHandler = mark_content_start
+            parser.StartCdataSectionHandler = mark_content_start
+            parser.ProcessingInstructionHandler = mark_content_start
+
+        for chunk in self._read_source(xml_path):
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
 
     def _parse_folder(self, xml_element, current_folder, current_path):
-        for child in xml_element:
-            if child.tag == 'folder':
-                folder_name = child.get('name', '')
-                folder_path = os.path.join(current_path, folder_name).replace('\\', '/')
-                new_folder = VFSFolder(folder_name, folder_path)
-                current_folder.children[folder_name] = new_folder
-                self._parse_folder(child, new_folder, folder_path)
+        # Обход без рекурсии: явный стек итераторов по детям элементов, поэтому
+        # глубина образа не ограничена пределом рекурсии Python. Порядок создания
+        # узлов тот же, что при рекурсивном обходе.
+        stack = [(iter(xml_element), current_folder, current_path)]
+        while stack:
+            children, folder, folder_path = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+
+            elif child.tag == 'folder':
+                new_folder, new_path = self._add_folder(folder, folder_path, child.get('name', ''))
+                stack.append((iter(child), new_folder, new_path))
 
             elif child.tag == 'file':
-                file_name = child.get('name', '')
-                file_path = os.path.join(current_path, file_name).replace('\\', '/')
-                encoding = child.get('encoding', 'text')
-                content = child.text or ""
-
-                if encoding == 'base64' and content:
-                    try:
-                        content = base64.b64decode(content).decode('utf-8')
-                    except Exception as e:
-                        print(f"Ошибка декодирования base64 файла {file_name}: {e}")
+                self._add_file(folder, folder_path, child.get('name', ''),
+                               child.get('encoding', 'text'), child.text or "")
+
+    # Загрузчики передают путь папки вместе с ней: узлы путь не хранят,
+    # а собирать его по родителям для каждого нового узла слишком дорого
+    def _add_folder(self, folder, folder_path, folder_name):
+        new_folder = VFSFolder(sys.intern(folder_name))
+        return new_folder, self._attach(folder, folder_path, new_folder)
+
+    def _add_file(self, folder, folder_path, file_name, encoding, content):
+        deferred = None
+        if isinstance(content, str):
+            if self._decoder is not None and encoding == 'base64' and content:
+                # Декодируется в пуле процессов, содержимое присвоит _finish_decoding
+                deferred, content = content, ""
+            else:
+                content = decode_content(content, encoding, file_name, self.log)
+                if self.dedup and content:
+                    content = self._dedup_blob(content)
+
+        new_file = VFSFile(sys.intern(file_name), content, sys.intern(encoding))
+        self._attach(folder, folder_path, new_file)
+        if deferred is not None:
+            self._decoder.add(new_file, deferred)
+
+    def _dedup_blob(self, text):
+        # Общий Blob для уже встречавшегося при загрузке содержимого
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = self.blobs[digest] = Blob(text, digest)
+        else:
+            blob.refs += 1
+            self.dedup_saved += len(data)
+        return blob
+
+    def _attach(self, folder, folder_path, node):
+        # Добавляет узел в папку и в индекс путей, заменяя одноименный узел.
+        # Возвращает путь добавленного узла.
+        path = join_path(folder_path, node.name)
+        existing = folder.children.get(node.name)
+        if existing is not None:
+            self._unindex(existing, path)
+            self._release(existing)
+            existing.parent = None
+        node.parent = folder
+        folder.children[node.name] = node
+        folder.invalidate_hash()
+        if self.trigrams is not None:
+            self._trigram_mark(node)
+        if self.use_index:
+            self.index[path] = node
+            self._name_add(node)
+            if isinstance(node, VFSFolder) and node.children:
+                self._index_subtree(node, path)
+        return path
+
+    def _index_subtree(self, folder, path):
+        # Индексирует поддерево, добавленное целиком (например, cp -r)
+        stack = [(folder, path)]
+        while stack:
+            current, current_path = stack.pop()
+            for name, child in current.children.items():
+                child_path = join_path(current_path, name)
+                self.index[child_path] = child
+                self._name_add(child)
+                if isinstance(child, VFSFolder):
+                    stack.append((child, child_path))
+
+    def _release(self, node):
+        # Отдает ссылки на содержимое всех файлов удаляемого поддерева;
+        # блоки, на которые больше никто не ссылается, уходят из хранилища
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, VFSFolder):
+                stack.extend(current.children.values())
+                continue
+            if self.trigrams is not None:
+                self._trigram_drop(current)
+            blob = current.release()
+            if blob is not None and blob.digest is not None:
+                self.blobs.pop(blob.digest, None)
+
+    def _unindex(self, node, path):
+        # Убирает из индекса узел вместе со всем его поддеревом
+        if not self.use_index:
+            return
+        stack = [(node, path)]
+        while stack:
+            current, current_path = stack.pop()
+            if self.index.get(current_path) is current:
+                del self.index[current_path]
+                self._name_remove(current)
+            if isinstance(current, VFSFolder):
+                stack.extend((child, join_path(current_path, name))
+                             for name, child in current.children.items())
+
+    def _name_add(self, node):
+        # Единственный узел с таким именем хранится без множества - так дешевле по памяти
+        entry = self.names.get(node.name)
+        if entry is None:
+            self.names[node.name] = node
+        elif isinstance(entry, set):
+            entry.add(node)
+        elif entry is not node:
+            self.names[node.name] = {entry, node}
+
+    def _name_remove(self, node):
+        entry = self.names.get(node.name)
+        if entry is node:
+            del self.names[node.name]
+        elif isinstance(entry, set):
+            entry.discard(node)
+            if len(entry) == 1:
+                self.names[node.name] = entry.pop()
+
+    def _named(self, pattern):
+        # Узлы, имя которых подходит под шаблон: точное имя ищется в индексе сразу,
+        # для шаблона с * ? [ перебираются только различные имена, а не дерево
+        if any(c in pattern for c in '*?['):
+            names = [name for name in self.names if fnmatch.fnmatchcase(name, pattern)]
+        else:
+            names = [pattern] if pattern in self.names else []
+        for name in names:
+            entry = self.names[name]
+            if isinstance(entry, set):
+                yield from entry
+            else:
+                yield entry
+
+    def find(self, start, name=None, kind=None, maxdepth=None):
+        # Поиск в поддереве узла start: name - шаблон имени (glob), kind - 'f' или 'd',
+        # maxdepth - наибольшая глубина от start. Возвращает пары (путь, узел)
+        # в порядке обхода с отсортированными именами. С шаблоном имени
+        # кандидаты берутся из индекса имен, иначе поддерево обходится walk.
+        start_path = start.path
+        if name is None or not self.use_index:
+            found = ((path, node) for path, node, depth in self.walk(start, start_path, maxdepth)
+                     if name is None or (node is not self.root and fnmatch.fnmatchcase(node.name, name)))
+        else:
+            found = []
+            if start is not self.root and fnmatch.fnmatchcase(start.name, name):
+                found.append((start_path, start))
+            for node in self._named(name):
+                depth = self._depth_below(node, start)
+                if depth is not None and depth > 0 and (maxdepth is None or depth <= maxdepth):
+                    found.append((node.path, node))
+            found.sort(key=lambda item: item[0].split('/'))
+
+        if kind == 'f':
+            return [item for item in found if isinstance(item[1], VFSFile)]
+        if kind == 'd':
+            return [item for item in found if isinstance(item[1], VFSFolder)]
+        return list(found)
+
+    @staticmethod
+    def _depth_below(node, ancestor):
+        # Глубина node относительно ancestor или None, если node не в его поддереве
+        depth = 0
+        while node is not None:
+            if node is ancestor:
+                return depth
+            node = node.parent
+            depth += 1
+        return None
 
-                new_file = VFSFile(file_name, file_path, content, encoding)
-                current_folder.children[file_name] = new_file
+    @staticmethod
+    def walk(start, start_path, maxdepth=None):
+        # Обход поддерева без рекурсии: (путь, узел, глубина) в прямом порядке,
+        # дети каждой папки - в порядке сортировки имен
+        stack = [(start_path, start, 0)]
+        while stack:
+            path, node, depth = stack.pop()
+            yield path, node, depth
+            if isinstance(node, VFSFolder) and (maxdepth is None or depth < maxdepth):
+                stack.extend((join_path(path, name), node.children[name], depth + 1)
+                             for name in sorted(node.children, reverse=True))
+
+    def grep_candidates(self, regex):
+        # Множество файлов, в которых может быть совпадение regex, по триграммному
+        # индексу. None - индекс выключен или шаблон не дает триграмм, тогда
+        # искать нужно во всех файлах.
+        if not self.trigram_index:
+            return None
+        grams = regex_trigrams(regex)
+        if not grams:
+            return None
+        self._update_trigrams()
+        postings = sorted((self.trigrams.get(gram, set()) for gram in grams), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def select(self, nodes, start):
+        # Пары (путь, узел) для узлов из nodes, лежащих в поддереве start,
+        # в том же порядке, что и при обходе walk
+        found = [(node.path, node) for node in nodes if self._depth_below(node, start) is not None]
+        found.sort(key=lambda item: item[0].split('/'))
+        return found
+
+    def _update_trigrams(self):
+        # Первый поиск индексирует все файлы, следующие - только измененные
+        if self.trigrams is None:
+            self.trigrams = {}
+            self._file_trigrams = {}
+            self._trigram_stale = set()
+            for _, node, _ in self.walk(self.root, "/"):
+                if isinstance(node, VFSFile):
+                    self._trigram_add(node)
+            return
+        stale, self._trigram_stale = self._trigram_stale, set()
+        for node in stale:
+            self._trigram_drop(node)
+            self._trigram_add(node)
+
+    def _trigram_add(self, node):
+        # Содержимое читается блоками и не остается у файла в режимах lazy и mmap;
+        # последние два символа блока переносятся, чтобы не потерять триграммы на стыке
+        grams = set()
+        tail = ""
+        for chunk in node.iter_chunks():
+            text = tail + fold_case(chunk)
+            grams.update(text[i:i + 3] for i in range(len(text) - 2))
+            tail = text[-2:]
+        grams = frozenset(grams)
+        self._file_trigrams[node] = grams
+        for gram in grams:
+            files = self.trigrams.get(gram)
+            if files is None:
+                self.trigrams[gram] = {node}
+            else:
+                files.add(node)
+
+    def _trigram_drop(self, node):
+        self._trigram_stale.discard(node)
+        for gram in self._file_trigrams.pop(node, ()):
+            files = self.trigrams[gram]
+            files.discard(node)
+            if not files:
+                del self.trigrams[gram]
+
+    def _trigram_mark(self, node):
+        # Новые и перезаписанные файлы индексируются при следующем поиске
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, VFSFolder):
+                stack.extend(current.children.values())
+            else:
+                self._trigram_stale.add(current)
 
     def calculate_sha256(self):
-        if not self.raw_data:
+        # Хеш исходного XML считается один раз при чтении образа и дальше берется
+        # из кеша. Он описывает образ, а не дерево, поэтому cp и rmdir его не
+        # сбрасывают; пересчитываем, только если исходный файл изменился на диске
+        # (или кеш сброшен mark_modified).
+        if not self.loaded:
             return "N/A"
-        return hashlib.sha256(self.raw_data.encode('utf-8')).hexdigest()
+        if self._sha256 is None or self._source_changed():
+            try:
+                for _ in self._read_source(self.source_path):
+                    pass
+            except OSError:
+                return self._sha256 or "N/A"
+        return self._sha256
+
+    def _source_changed(self):
+        try:
+            return self._stat_source(self.source_path) != self._source_stamp
+        except OSError:
+            return False
+
+    def mark_modified(self):
+        # Сбрасывает кеш хеша образа: следующее обращение к sha256 перечитает файл
+        self._sha256 = None
+
+    @property
+    def sha256(self):
+        # Хеш вычисляется только при обращении
+        return self.calculate_sha256()
 
     def get_info(self):
         return {
             'name': self.name,
-            'sha256': self.calculate_sha256(),
-            'loaded': bool(self.raw_data)
+            'sha256': self.sha256,
+            'loaded': self.loaded
         }
 
+    def node_hash(self, node):
+        # Хеш узла в дереве Меркла. Файл: SHA-256 содержимого в UTF-8.
+        # Папка: SHA-256 от имен детей в порядке сортировки и их хешей, поэтому
+        # хеш папки меняется при любом изменении в ее поддереве. Посчитанные хеши
+        # запоминаются в узлах, после изменения пересчитываются только узлы
+        # от измененного до корня.
+        stack = [(node, False)]
+        while stack:
+            current, ready = stack.pop()
+            if current._hash is not None:
+                continue
+            if isinstance(current, VFSFile):
+                current._hash = self._file_hash(current)
+            elif not ready:
+                stack.append((current, True))
+                stack.extend((child, False) for child in current.children.values()
+                             if child._hash is None)
+            else:
+                digest = hashlib.sha256(b'D')
+                children = current.children
+                for name in sorted(children):
+                    digest.update(name.encode('utf-8', 'surrogatepass'))
+                    digest.update(b'\0')
+                    digest.update(children[name]._hash)
+                current._hash = digest.digest()
+        return node._hash
+
+    @staticmethod
+    def _file_hash(node):
+        # Содержимое хешируется блоками (iter_chunks) и не остается у файла
+        digest = hashlib.sha256(b'F')
+        view = node.raw_view()
+        if view is not None:
+            digest.update(view)
+        else:
+            for chunk in node.iter_chunks():
+                digest.update(chunk.encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+
+    @property
+    def merkle_root(self):
+        return self.node_hash(self.root).hex()
+
+    @property
+    def known_merkle_root(self):
+        # Корневой хеш, если он уже посчитан и с тех пор не сброшен, иначе None
+        digest = self.root._hash
+        return digest.hex() if digest is not None else None
+
+    def diff(self, other):
+        # Различия с другой VFS: ('-', путь) - есть только здесь, ('+', путь) - только
+        # в other, ('~', путь) - файл изменился или сменил тип. Поддеревья с равными
+        # хешами не обходятся, поэтому после подсчета хешей время зависит
+        # от числа измененных поддеревьев, а не от размера образа.
+        if self.node_hash(self.root) == other.node_hash(other.root):
+            return
+        stack = [(self.root, other.root, "/")]
+        while stack:
+            mine, theirs, path = stack.pop()
+            nested = []
+            for name in sorted(mine.children.keys() | theirs.children.keys()):
+                a = mine.children.get(name)
+                b = theirs.children.get(name)
+                child_path = join_path(path, name)
+                if b is None:
+                    yield '-', child_path
+                elif a is None:
+                    yield '+', child_path
+                elif a._hash == b._hash:
+                    continue
+                elif isinstance(a, VFSFolder) and isinstance(b, VFSFolder):
+                    nested.append((a, b, child_path))
+                else:
+                    yield '~', child_path
+            stack.extend(reversed(nested))
+
     # НОВЫЕ МЕТОДЫ ДЛЯ ЭТАПА 4
     def get_node(self, path):
+        # path - нормализованный абсолютный путь
         if path == "/":
             return self.root
 
+        if self.use_index:
+            return self.index.get(path.rstrip('/'))
+
         parts = [p for p in path.split('/') if p]  # Убираем пустые части
         current = self.root
 
@@ -111,60 +1596,244 @@ class VirtualFileSystem:
                 return None
         return current
 
-    def list_directory(self, path):
-        node = self.get_node(path)
+    def resolve(self, path):
+        # Находит узел и его родителя за один поиск
+        if path == "/":
+            return ResolvedPath("/", self.root, None, "")
+
+        parent_path, _, name = path.rstrip('/').rpartition('/')
+        parent = self.get_node(parent_path or "/")
+        if not isinstance(parent, VFSFolder):
+            return ResolvedPath(path, None, None, name)
+        return ResolvedPath(path, parent.children.get(name), parent, name)
+
+    def _lookup(self, target):
+        # target - путь или уже разрешенный ResolvedPath
+        if isinstance(target, ResolvedPath):
+            return target.node
+        return self.get_node(target)
+
+    def list_directory(self, target):
+        node = self._lookup(target)
         if node and isinstance(node, VFSFolder):
             return list(node.children.keys())
         return None
 
-    def is_directory(self, path):
-        node = self.get_node(path)
+    def is_directory(self, target):
+        node = self._lookup(target)
         return node and isinstance(node, VFSFolder)
 
-    def read_file(self, path):
-        node = self.get_node(path)
+    def read_file(self, target):
+        node = self._lookup(target)
         if node and isinstance(node, VFSFile):
             return node.content
         return None
 
+    def copy_node(self, node, folder, name):
+        # Изменения дерева идут только через copy_node/remove_node/write_file,
+        # чтобы индексы, хеши и журнал оставались согласованными.
+        # Копия узла (для папки - всего поддерева), разделяющая содержимое файлов.
+        # В журнал пишутся только пути, а не содержимое.
+        source_path = node.path
+        path = self._attach(folder, folder.path, node.copy_as(name))
+        self._journal({'op': 'cp', 'src': source_path, 'path': path})
+        return path
+
+    def remove_node(self, folder, name):
+        node = folder.children.pop(name, None)
+        if node is None:
+            return False
+        path = join_path(folder.path, name)
+        self._unindex(node, path)
+        self._release(node)
+        node.parent = None
+        folder.invalidate_hash()
+        self._journal({'op': 'rm', 'path': path})
+        return True
+
+    def write_file(self, target, text):
+        # Записывает текст в существующий файл. Копии файла (cp) продолжают
+        # ссылаться на прежнее содержимое; одинаковый записанный текст
+        # хранится один раз.
+        node = self._lookup(target)
+        if not isinstance(node, VFSFile):
+            return False
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        blob = self.blobs.get(digest)
+        if blob is node._content:
+            return True
+        self._release(node)
+        if blob is None:
+            blob = self.blobs[digest] = Blob(text, digest)
+        else:
+            blob.refs += 1
+        node._content = blob
+        node.encoding = "text"
+        node.invalidate_hash()
+        if self.trigrams is not None:
+            self._trigram_mark(node)
+        self._journal({'op': 'write', 'path': node.path, 'text': text})
+        return True
+
+
 
 
+def split_command(command_line):
+    # shlex.split, но строка без кавычек и экранирования делится обычным split()
+    if SHLEX_SPECIAL.search(command_line) is None:
+        return command_line.split()
+    return shlex.split(command_line)
+
+
+class Command:
+    # Запись реестра команд ShellEm. Число аргументов (min_args..max_args,
+    # max_args=None - без ограничения) и загрузка VFS проверяются в одном месте,
+    # в ShellEm._dispatch, до вызова обработчика. missing - сообщение, когда
+    # аргументов не хватает; description - строка для help.
+    __slots__ = ('name', 'handler', 'min_args', 'max_args', 'needs_vfs', 'missing', 'description')
+
+    def __init__(self, name, handler, min_args=0, max_args=None, needs_vfs=False,
+                 missing=None, description=""):
+        self.name = name
+        self.handler = handler
+        self.min_args = min_args
+        self.max_args = max_args
+        self.needs_vfs = needs_vfs
+        self.missing = missing
+        self.description = description
+
+
+class PlannedCommand:
+    # Строка скрипта, разобранная заранее: имя команды, запись реестра
+    # (None для неизвестной) и аргументы. error - ошибка разбора shlex,
+    # она выводится в момент выполнения строки, как и раньше.
+    __slots__ = ('line_num', 'text', 'name', 'command', 'args', 'error')
+
+    def __init__(self, line_num, text, name=None, command=None, args=None, error=None):
+        self.line_num = line_num
+        self.text = text
+        self.name = name
+        self.command = command
+        self.args = args
+        self.error = error
+
 
 class ShellEm:
-    def __init__(self, vfs_path=None, script_path=None):
+    def __init__(self, vfs_path=None, script_path=None, vfs_mode="stream", use_index=True,
+                 cache_size=None, snapshot_path=None, output=None, dedup=False, decode_workers=None,
+                 quiet=False, journal_path=None, grep_workers=None, trigram_index=False):
         self.current_path = "/"
-        self.user = os.getlogin()
+        self.quiet = quiet  # не выводить приглашение перед каждой командой скрипта
+        self._prompt = None  # (current_path, приглашение) - пересобирается только после cd
+        self._path_cache = OrderedDict()  # (current_path, аргумент) -> нормализованный путь
+        self._regex_cache = OrderedDict()  # (шаблон, флаги) -> скомпилированное выражение grep
+        self.grep_workers = grep_workers   # процессов для grep -r (None - без пула)
+        self._grep_pool = None             # пул grep на весь сеанс, создается при первой надобности
+        self.out = OutputSink(output)
+        try:
+            self.user = os.getlogin()
+        except OSError:
+            # Нет управляющего терминала (пакетный запуск, перенаправленный вывод)
+            self.user = getpass.getuser()
         self.hostname = socket.gethostname()
         self.script_path = script_path
-        self.vfs = VirtualFileSystem()
+        self.vfs = VirtualFileSystem(use_index=use_index)
+        self.vfs.log = self._print
+
+        # Реестр команд: имя -> Command. Обработчик возвращает True при успехе,
+        # False при ошибке и None для выхода из эмулятора. Порядок регистрации -
+        # порядок команд в help.
+        self.commands = {}
+        self.register(Command('ls', self.ls, 0, 1, needs_vfs=True,
+                              description="ls [путь] - показать содержимое директории"))
+        self.register(Command('cd', self.cd, 0, 1, needs_vfs=True,
+                              description="cd [путь] - сменить директорию"))
+        self.register(Command('cal', self.cal, 0, 2,
+                              description="cal [год] или cal [месяц] [год] - вывод календаря"))
+        self.register(Command('cat', self.cat, 1, needs_vfs=True,
+                              missing="Ошибка: укажите файл для просмотра",
+                              description="cat [-n] [файл...] - показать содержимое файлов "
+                                          "(-n - нумеровать строки)"))
+        self.register(Command('uniq', self.uniq, 1, needs_vfs=True,
+                              missing="Ошибка: укажите файл",
+                              description="uniq [-c] [-d] [-u] [-f N] [-s N] [файл] - "
+                                          "фильтрация повторяющихся строк"))
+        self.register(Command('find', self.find, needs_vfs=True,
+                              description="find [путь] [-name шаблон] [-type f|d] [-maxdepth N] - "
+                                          "поиск файлов и директорий"))
+        self.register(Command('grep', self.grep, 2, needs_vfs=True,
+                              missing="Ошибка: использование: grep [-r] [-i] [-c] [-n] <шаблон> <путь>",
+                              description="grep [-r] [-i] [-c] [-n] <шаблон> <путь> - поиск строк "
+                                          "по регулярному выражению"))
+        self.register(Command('uname', self.uname,
+                              description="uname - информация о системе"))
+        self.register(Command('vfs-info', self.vfs_info, 0, 1,
+                              description="vfs-info [-m] - информация о загруженной VFS "
+                                          "(-m - посчитать корневой хеш Меркла)"))
+        self.register(Command('vfs-compact', self.vfs_compact, 0, 1, needs_vfs=True,
+                              description="vfs-compact [файл] - записать VFS вместе с изменениями "
+                                          "в новый XML-образ"))
+        self.register(Command('vfs-diff', self.vfs_diff, 0, 1, needs_vfs=True,
+                              description="vfs-diff [файл] - сравнить VFS с XML-образом "
+                                          "(по умолчанию - с исходным)"))
+        self.register(Command('exit', self.exit_shell, 0, 0,
+                              description="exit - выход из эмулятора"))
+        self.register(Command('help', self.help,
+                              description="help - показать эту справку"))
+        self.register(Command('rmdir', self.rmdir, 1, 1, needs_vfs=True,
+                              missing="Ошибка: укажите директорию для удаления",
+                              description="rmdir [директория] - удалить пустую директорию"))
+        self.register(Command('cp', self.cp, 2, 3, needs_vfs=True,
+                              missing="Ошибка: использование: cp [-r] <источник> <назначение>",
+                              description="cp [-r] <источник> <назначение> - копировать файл "
+                                          "(-r - директорию)"))
 
         vfs_loaded = False
         if vfs_path:
-            vfs_loaded = self.vfs.load_from_xml(vfs_path)
+            vfs_loaded = self.vfs.load_from_xml(vfs_path, mode=vfs_mode, cache_size=cache_size,
+                                                 snapshot_path=snapshot_path, dedup=dedup,
+                                                 decode_workers=decode_workers,
+                                                 journal_path=journal_path,
+                                                 trigram_index=trigram_index)
             if not vfs_loaded:
-                print("Не удалось загрузить VFS. Завершение работы.")
+                self._print("Не удалось загрузить VFS. Завершение работы.")
+                self.out.flush()
                 sys.exit(1)
 
-        print("=== Конфигурация эмулятора ===")
-        print(f"VFS path: {vfs_path or 'Не указан'}")
-        print(f"Script path: {script_path or 'Не указан'}")
+        self._print("=== Конфигурация эмулятора ===")
+        self._print(f"VFS path: {vfs_path or 'Не указан'}")
+        self._print(f"Script path: {script_path or 'Не указан'}")
         if vfs_path:
-            vfs_info = self.vfs.get_info()
-            print(f"VFS name: {vfs_info['name']}")
-            print(f"VFS SHA-256: {vfs_info['sha256']}")
-        print("=" * 30)
+            self._print(f"VFS name: {self.vfs.name}")
+            self._print(f"VFS SHA-256: {self.vfs.sha256}")
+        self._print("=" * 30)
+
+    def register(self, command):
+        # Новая команда добавляется одной записью, диспетчер менять не нужно
+        self.commands[command.name] = command
 
     def run(self):
-        if self.script_path:
-            self.run_script()
-        else:
-            self.run_interactive()
+        try:
+            if self.script_path:
+                self.run_script()
+            else:
+                self.run_interactive()
+        finally:
+            self.out.flush()
+            if self._grep_pool is not None:
+                self._grep_pool.shutdown()
+                self._grep_pool = None
+
+    def _print(self, *values, sep=' ', end='\n'):
+        # Замена print() для вывода команд: пишет в буферизованный self.out
+        self.out.write(sep.join(map(str, values)) + end)
 
     def run_interactive(self):
         while True:
             try:
                 display_path = self._get_display_path()
                 prompt = f"{self.user}@{self.hostname}:{display_path}$ "
+                self.out.flush()
                 command_input = input(prompt).strip()
 
                 if not command_input:
@@ -177,40 +1846,80 @@ class ShellEm:
                     continue
 
             except KeyboardInterrupt:
-                print("\n")
+                self._print("\n")
                 break
             except Exception as e:
-                print(f"Ошибка: {e}")
+                self._print(f"Ошибка: {e}")
 
     def run_script(self):
+        # Скрипт читается и выполняется построчно, целиком в памяти не держится.
+        # "-" - читать команды из стандартного ввода.
         try:
-            with open(self.script_path, 'r', encoding='utf-8') as file:
-                commands = file.readlines()
+            if self.script_path == '-':
+                self._print("Выполнение скрипта: стандартный ввод")
+                self._print("-" * 50)
+                self.run_plan(self.compile_script(sys.stdin))
+                return
 
-            print(f"Выполнение скрипта: {self.script_path}")
-            print("-" * 50)
-
-            for line_num, command_line in enumerate(commands, 1):
-                command_line = command_line.strip()
+            with open(self.script_path, 'r', encoding='utf-8') as file:
+                self._print(f"Выполнение скрипта: {self.script_path}")
+                self._print("-" * 50)
+                self.run_plan(self.compile_script(file))
 
-                if not command_line or command_line.startswith('#'):
-                    continue
+        except FileNotFoundError:
+            self._print(f"Ошибка: скрипт '{self.script_path}' не найден")
+        except Exception as e:
+            self._print(f"Ошибка при выполнении скрипта: {e}")
+
+    def compile_script(self, lines):
+        # Разбирает строки скрипта по мере чтения: пустые строки и комментарии
+        # отбрасываются, имена команд сразу сопоставляются с реестром команд.
+        # План отдается по одной команде, поэтому первая команда выполняется
+        # сразу, а память не зависит от длины скрипта.
+        for line_num, command_line in enumerate(lines, 1):
+            command_line = command_line.strip()
+            if command_line and not command_line.startswith('#'):
+                yield self._compile_line(line_num, command_line)
+
+    def _compile_line(self, line_num, command_line):
+        try:
+            parsed_args = split_command(command_line)
+        except ValueError as e:
+            return PlannedCommand(line_num, command_line, error=e)
+        name = parsed_args[0]
+        return PlannedCommand(line_num, command_line, name, self.commands.get(name), parsed_args[1:])
+
+    def run_plan(self, plan):
+        # Выполняет заранее разобранные команды до exit или первой ошибки
+        for step in plan:
+            if not self.quiet:
+                self._print(f"{self._script_prompt()}{step.text}")
+
+            if step.error is not None:
+                self._print(f"Ошибка парсинга: {step.error}")
+                result = False
+            else:
+                result = self._dispatch(step.name, step.command, step.args, True)
 
-                display_path = self._get_display_path()
-                print(f"{self.user}@{self.hostname}:{display_path}$ {command_line}")
+            if result is None:
+                self._print("Скрипт завершен")
+                break
+            elif not result:
+                self._print(f"Ошибка в строке {step.line_num}. Остановка выполнения.")
+                break
 
-                result = self.execute_command(command_line, from_script=True)
-                if result is None:
-                    print("Скрипт завершен")
-                    break
-                elif not result:
-                    print(f"Ошибка в строке {line_num}. Остановка выполнения.")
-                    break
+    def _script_prompt(self):
+        if self._prompt is None or self._prompt[0] != self.current_path:
+            prompt = f"{self.user}@{self.hostname}:{self._get_display_path()}$ "
+            self._prompt = (self.current_path, prompt)
+        return self._prompt[1]
 
-        except FileNotFoundError:
-            print(f"Ошибка: скрипт '{self.script_path}' не найден")
-        except Exception as e:
-            print(f"Ошибка при выполнении скрипта: {e}")
+    def _require_vfs(self):
+        # Общая проверка для команд, работающих с VFS
+        if not self.vfs.loaded:
+            self._print("Ошибка: VFS не загружена")
+            return False
+        return True
 
     def _get_display_path(self):
         if self.current_path == "/":
@@ -220,6 +1929,34 @@ class ShellEm:
             return f"~/{parts[-1]}" if parts else "~"
 
     def _normalize_path(self, target_path):
+        # Уже нормализованный абсолютный путь возвращается как есть
+        if target_path.startswith('/') and self._is_normalized(target_path):
+            return target_path
+
+        # Остальные результаты запоминаются в LRU-кеше. Текущая директория входит
+        # в ключ, поэтому после cd кеш не нужно сбрасывать: старые записи просто
+        # перестают совпадать и вытесняются.
+        key = (self.current_path, target_path)
+        cache = self._path_cache
+        path = cache.get(key)
+        if path is not None:
+            cache.move_to_end(key)
+            return path
+
+        path = self._build_path(target_path)
+        cache[key] = path
+        if len(cache) > PATH_CACHE_SIZE:
+            cache.popitem(last=False)
+        return path
+
+    @staticmethod
+    def _is_normalized(path):
+        if path == '/':
+            return True
+        return not (path.endswith(('/', '/.', '/..')) or '//' in path
+                    or '/./' in path or '/../' in path)
+
+    def _build_path(self, target_path):
         if target_path.startswith('/'):
             # Абсолютный путь
             path = target_path
@@ -243,108 +1980,91 @@ class ShellEm:
 
         return '/' + '/'.join(parts) if parts else '/'
 
+    def _resolve(self, target_path):
+        # Нормализует аргумент команды и разрешает его в VFS один раз
+        return self.vfs.resolve(self._normalize_path(target_path))
+
     def execute_command(self, command_input, from_script=False):
         try:
-            parsed_args = shlex.split(command_input)
+            parsed_args = split_command(command_input)
         except ValueError as e:
-            print(f"Ошибка парсинга: {e}")
+            self._print(f"Ошибка парсинга: {e}")
             return False
 
-        command = parsed_args[0]
-        args = parsed_args[1:]
+        name = parsed_args[0]
+        return self._dispatch(name, self.commands.get(name), parsed_args[1:], from_script)
 
-        if command == 'exit':
-            if not args:
-                return None
-            else:
-                print("Команда exit не принимает аргументы")
-        elif command == 'ls':
-            return self.ls(args)
-        elif command == 'cd':
-            return self.cd(args)
-        elif command == 'help':
-            self.help()
-        elif command == 'vfs-info':
-            self.vfs_info(args)
-        elif command == 'cal':
-            return self.cal(args)
-        elif command == 'uniq':
-            return self.uniq(args)
-        elif command == 'uname':
-            return self.uname(args)
-        elif command == 'rmdir':
-            return self.rmdir(args)
-        elif command == 'cp':
-            return self.cp(args)
-        elif command == 'cat':
-            return self.cat(args)
-        else:
-            print(f"Ошибка: неизвестная команда '{command}'")
-            if from_script:
-                return False
-        return True
+    def _dispatch(self, name, command, args, from_script):
+        # Общие проверки всех команд: известна ли команда, загружена ли VFS
+        # и подходит ли число аргументов
+        if command is None:
+            self._print(f"Ошибка: неизвестная команда '{name}'")
+            return not from_script
 
-    def ls(self, args):
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
+        if command.needs_vfs and not self._require_vfs():
+            return False
+
+        if len(args) < command.min_args:
+            self._print(command.missing or "Ошибка: недостаточно аргументов")
             return False
 
+        if command.max_args is not None and len(args) > command.max_args:
+            if command.max_args == 0:
+                self._print(f"Команда {name} не принимает аргументы")
+            else:
+                self._print("Ошибка: слишком много аргументов")
+            return False
+
+        return command.handler(args)
+
+    def exit_shell(self, args):
+        return None
+
+    def ls(self, args):
         if args:
-            if len(args) > 1:
-                print("Ошибка: слишком много аргументов")
-                return False
-            target_path = self._normalize_path(args[0])
+            target = self._resolve(args[0])
         else:
-            target_path = self.current_path
+            target = self.vfs.resolve(self.current_path)
 
-        if not self.vfs.get_node(target_path):
-            print(f"Ошибка: путь не существует: {target_path}")
+        if not target.node:
+            self._print(f"Ошибка: путь не существует: {target.path}")
             return False
 
-        if not self.vfs.is_directory(target_path):
-            print(f"Ошибка: не является директорией: {target_path}")
+        if not self.vfs.is_directory(target):
+            self._print(f"Ошибка: не является директорией: {target.path}")
             return False
 
-        items = self.vfs.list_directory(target_path)
+        items = self.vfs.list_directory(target)
         if items is None:
-            print(f"Ошибка при чтении директории: {target_path}")
+            self._print(f"Ошибка при чтении директории: {target.path}")
             return False
 
         if not items:
-            print("Директория пуста")
+            self._print("Директория пуста")
         else:
             for item in sorted(items):
-                print(item)
+                self._print(item)
 
         return True
 
     def cd(self, args):
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
-            return False
-
         if not args:
             self.current_path = "/"
             return True
 
-        if len(args) > 1:
-            print("Ошибка: слишком много аргументов")
-            return False
-
-        target_path = self._normalize_path(args[0])
+        target = self._resolve(args[0])
 
         # Проверяем существование пути
-        if not self.vfs.get_node(target_path):
-            print(f"Ошибка: путь не существует: {target_path}")
+        if not target.node:
+            self._print(f"Ошибка: путь не существует: {target.path}")
             return False
 
         # Проверяем, что это директория
-        if not self.vfs.is_directory(target_path):
-            print(f"Ошибка: не является директорией: {target_path}")
+        if not self.vfs.is_directory(target):
+            self._print(f"Ошибка: не является директорией: {target.path}")
             return False
 
-        old_path = self.current_path
-        self.current_path = target_path
+        self.current_path = target.path
         return True
 
     def cal(self, args):
@@ -353,69 +2073,293 @@ class ShellEm:
         try:
             if len(args) == 0:
                 # cal - текущий месяц
-                print(calendar.month(now.year, now.month))
+                self._print(calendar.month(now.year, now.month))
             elif len(args) == 1:
                 # cal <год>
                 year = int(args[0])
                 if 1 <= year <= 9999:
-                    print(calendar.calendar(year))
+                    self._print(calendar.calendar(year))
                 else:
-                    print("Ошибка: год должен быть в диапазоне 1-9999")
+                    self._print("Ошибка: год должен быть в диапазоне 1-9999")
                     return False
-            elif len(args) == 2:
+            else:
                 # cal <месяц> <год>
                 month = int(args[0])
                 year = int(args[1])
                 if 1 <= month <= 12 and 1 <= year <= 9999:
-                    print(calendar.month(year, month))
+                    self._print(calendar.month(year, month))
                 else:
-                    print("Ошибка: месяц должен быть 1-12, год 1-9999")
+                    self._print("Ошибка: месяц должен быть 1-12, год 1-9999")
                     return False
-            else:
-                print("Ошибка: неверное количество аргументов")
-                print("Использование: cal [год] или cal [месяц] [год]")
-                return False
         except ValueError:
-            print("Ошибка: аргументы должны быть числами")
+            self._print("Ошибка: аргументы должны быть числами")
             return False
 
         return True
 
     def uniq(self, args):
-        if not args:
-            print("Ошибка: укажите файл")
-            return False
+        # uniq [-c] [-d] [-u] [-f N] [-s N] файл
+        show_count = only_repeated = only_unique = False
+        skip_fields = skip_chars = 0
+        files = []
+        args_iter = iter(args)
+        for arg in args_iter:
+            if arg in ('-f', '-s'):
+                value = next(args_iter, None)
+                if value is None or not value.isdecimal():
+                    self._print(f"Ошибка: параметр {arg} требует неотрицательное число")
+                    return False
+                if arg == '-f':
+                    skip_fields = int(value)
+                else:
+                    skip_chars = int(value)
+            elif arg.startswith('-') and len(arg) > 1:
+                for flag in arg[1:]:
+                    if flag == 'c':
+                        show_count = True
+                    elif flag == 'd':
+                        only_repeated = True
+                    elif flag == 'u':
+                        only_unique = True
+                    else:
+                        self._print(f"Ошибка: неизвестный параметр '-{flag}'")
+                        return False
+            else:
+                files.append(arg)
 
-        if len(args) > 1:
-            print("Ошибка: слишком много аргументов")
+        if not files:
+            self._print("Ошибка: укажите файл")
             return False
 
-        file_path = self._normalize_path(args[0])
-
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
+        if len(files) > 1:
+            self._print("Ошибка: слишком много аргументов")
             return False
 
         # Читаем файл из VFS
-        content = self.vfs.read_file(file_path)
-        if content is None:
-            print(f"Ошибка: файл не существует или не может быть прочитан: {file_path}")
+        target = self._resolve(files[0])
+        node = target.node
+        if not isinstance(node, VFSFile):
+            self._print(f"Ошибка: файл не существует или не может быть прочитан: {target.path}")
             return False
 
-        lines = content.split('\n')
-        unique_lines = []
-        previous_line = None
+        # Строки читаются по одной и сравниваются только с предыдущей группой,
+        # поэтому память не зависит от размера файла
+        group_line = None
+        group_key = None
+        count = 0
+        for line in node.iter_lines():
+            key = line if not (skip_fields or skip_chars) else self._uniq_key(line, skip_fields, skip_chars)
+            if count and key == group_key:
+                count += 1
+                continue
+            if count:
+                self._uniq_output(group_line, count, show_count, only_repeated, only_unique)
+            group_line, group_key, count = line, key, 1
 
-        for line in lines:
-            if line != previous_line:
-                unique_lines.append(line)
-                previous_line = line
+        if count:
+            self._uniq_output(group_line, count, show_count, only_repeated, only_unique)
 
-        for line in unique_lines:
-            print(line)
+        return True
 
+    @staticmethod
+    def _uniq_key(line, skip_fields, skip_chars):
+        # Часть строки, по которой сравнивает uniq: без первых skip_fields полей
+        # (пробелы + непробельные символы) и затем без skip_chars символов
+        pos = 0
+        length = len(line)
+        for _ in range(skip_fields):
+            while pos < length and line[pos] in ' \t':
+                pos += 1
+            while pos < length and line[pos] not in ' \t':
+                pos += 1
+        return line[pos + skip_chars:]
+
+    def _uniq_output(self, line, count, show_count, only_repeated, only_unique):
+        if only_repeated and count < 2:
+            return
+        if only_unique and count > 1:
+            return
+        if show_count:
+            self._print(f"{count:>7} {line}")
+        else:
+            self._print(line)
+
+    def find(self, args):
+        # find [путь] [-name шаблон] [-type f|d] [-maxdepth N]
+        start = None
+        name = kind = maxdepth = None
+        args_iter = iter(args)
+        for arg in args_iter:
+            if arg in ('-name', '-type', '-maxdepth'):
+                value = next(args_iter, None)
+                if value is None:
+                    self._print(f"Ошибка: параметр {arg} требует значение")
+                    return False
+                if arg == '-name':
+                    name = value
+                elif arg == '-type':
+                    if value not in ('f', 'd'):
+                        self._print("Ошибка: -type принимает f или d")
+                        return False
+                    kind = value
+                else:
+                    if not value.isdecimal():
+                        self._print("Ошибка: параметр -maxdepth требует неотрицательное число")
+                        return False
+                    maxdepth = int(value)
+            elif arg.startswith('-'):
+                self._print(f"Ошибка: неизвестный параметр '{arg}'")
+                return False
+            elif start is None:
+                start = arg
+            else:
+                self._print("Ошибка: слишком много аргументов")
+                return False
+
+        target = self._resolve(start) if start is not None else self.vfs.resolve(self.current_path)
+        if not target.node:
+            self._print(f"Ошибка: путь не существует: {target.path}")
+            return False
+
+        for path, node in self.vfs.find(target.node, name, kind, maxdepth):
+            self._print(path)
         return True
 
+    def grep(self, args):
+        # grep [-r] [-i] [-c] [-n] шаблон путь
+        recursive = ignore_case = count_only = numbers = False
+        operands = []
+        for arg in args:
+            if arg.startswith('-') and len(arg) > 1 and not operands:
+                for flag in arg[1:]:
+                    if flag == 'r':
+                        recursive = True
+                    elif flag == 'i':
+                        ignore_case = True
+                    elif flag == 'c':
+                        count_only = True
+                    elif flag == 'n':
+                        numbers = True
+                    else:
+                        self._print(f"Ошибка: неизвестный параметр '-{flag}'")
+                        return False
+            else:
+                operands.append(arg)
+
+        if len(operands) != 2:
+            self._print("Ошибка: использование: grep [-r] [-i] [-c] [-n] <шаблон> <путь>")
+            return False
+
+        try:
+            regex = self._compile_regex(operands[0], re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            self._print(f"Ошибка: неверное регулярное выражение: {e}")
+            return False
+
+        target = self._resolve(operands[1])
+        node = target.node
+        if not node:
+            self._print(f"Ошибка: путь не существует: {target.path}")
+            return False
+
+        if isinstance(node, VFSFolder):
+            if not recursive:
+                self._print(f"Ошибка: указанный путь является директорией: {target.path} (используйте grep -r)")
+                return False
+            # Триграммный индекс отсекает файлы, где совпадения быть не может;
+            # для -c они все равно выводятся (с нулем), поэтому обходится все поддерево
+            candidates = self.vfs.grep_candidates(regex)
+            if candidates is not None and not count_only:
+                files = self.vfs.select(candidates, node)
+            else:
+                files = [(path, child) for path, child, _ in self.vfs.walk(node, target.path)
+                         if isinstance(child, VFSFile)]
+        else:
+            candidates = None
+            files = [(target.path, node)]
+
+        searched = files
+        if candidates is not None and count_only:
+            searched = [item for item in files if item[1] in candidates]
+        if self.grep_workers and len(searched) > 1 and self._grep_large(searched):
+            results = self._grep_parallel(searched, regex, count_only)
+        else:
+            results = ((path, self._grep_file(file, regex, count_only)) for path, file in searched)
+        if searched is not files:
+            found = dict(results)
+            results = ((path, found.get(path, 0)) for path, _ in files)
+
+        # С -r перед каждой строкой выводится путь файла, как в grep для нескольких файлов
+        for path, result in results:
+            prefix = f"{path}:" if recursive else ""
+            if count_only:
+                self._print(f"{prefix}{result}")
+                continue
+            for number, line in result:
+                if numbers:
+                    self._print(f"{prefix}{number}:{line}")
+                else:
+                    self._print(f"{prefix}{line}")
+        return True
+
+    def _compile_regex(self, pattern, flags):
+        # Скомпилированные выражения держатся в LRU-кеше, чтобы повторяющийся
+        # в скрипте шаблон не компилировался заново
+        key = (pattern, flags)
+        cache = self._regex_cache
+        regex = cache.get(key)
+        if regex is not None:
+            cache.move_to_end(key)
+            return regex
+        regex = cache[key] = re.compile(pattern, flags)
+        if len(cache) > REGEX_CACHE_SIZE:
+            cache.popitem(last=False)
+        return regex
+
+    @staticmethod
+    def _grep_file(file, regex, count_only):
+        # Содержимое читается построчно (iter_lines), списка всех строк нет
+        matches = grep_lines(regex, file.iter_lines())
+        if count_only:
+            return sum(1 for _ in matches)
+        return matches
+
+    @staticmethod
+    def _grep_large(files):
+        # Пул окупается, только если файлов хватает хотя бы на одну полную пачку
+        size = 0
+        for _, file in files:
+            size += file.length_hint()
+            if size >= GREP_BATCH_SIZE:
+                return True
+        return False
+
+    def _grep_parallel(self, files, regex, count_only):
+        # Файлы делятся на пачки примерно по GREP_BATCH_SIZE символов, пачки
+        # обрабатываются в пуле процессов; результаты выдаются в исходном порядке.
+        # Файлы из отображенного образа передаются смещением, а не содержимым.
+        # Пул создается один раз и живет до конца сеанса.
+        if self._grep_pool is None:
+            self._grep_pool = ProcessPoolExecutor(max_workers=self.grep_workers)
+        pending = []
+        paths, items, size = [], [], 0
+        for index, (path, file) in enumerate(files, 1):
+            location = file.location()
+            if location is not None:
+                items.append(location)
+                size += location[2]
+            else:
+                content = file.content
+                items.append(content)
+                size += len(content)
+            paths.append(path)
+            if size >= GREP_BATCH_SIZE or index == len(files):
+                future = self._grep_pool.submit(grep_batch, regex.pattern, regex.flags, items, count_only)
+                pending.append((paths, future))
+                paths, items, size = [], [], 0
+        for batch_paths, future in pending:
+            yield from zip(batch_paths, future.result())
+
     def uname(self, args):
         info = [
             f"Операционная система: {sys.platform}",
@@ -425,172 +2369,282 @@ class ShellEm:
         ]
 
         for line in info:
-            print(line)
+            self._print(line)
 
         return True
 
     def vfs_info(self, args):
-        if args:
-            print("Команда vfs-info не принимает аргументы")
-            return
-
-        info = self.vfs.get_info()
-        if info['loaded']:
-            print(f"VFS name: {info['name']}")
-            print(f"SHA-256: {info['sha256']}")
+        # Хеш Меркла требует прочитать все файлы образа, поэтому без -m
+        # выводится, только если он уже посчитан (например, vfs-diff)
+        if args and args[0] != '-m':
+            self._print(f"Ошибка: неизвестный параметр '{args[0]}'")
+            return False
+        if self.vfs.loaded:
+            self._print(f"VFS name: {self.vfs.name}")
+            self._print(f"SHA-256: {self.vfs.sha256}")
+            merkle_root = self.vfs.merkle_root if args else self.vfs.known_merkle_root
+            self._print(f"Merkle root: {merkle_root or 'не посчитан (vfs-info -m)'}")
+            if self.vfs.dedup:
+                self._print(f"Дедупликация: сэкономлено {self.vfs.dedup_saved} байт")
+            if self.vfs.trigrams is not None:
+                self._print(f"Триграммный индекс: {len(self.vfs.trigrams)} триграмм, "
+                            f"{len(self.vfs._file_trigrams)} файлов")
         else:
-            print("VFS не загружена")
+            self._print("VFS не загружена")
+        return True
 
-    def rmdir(self, args):
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
+    def vfs_compact(self, args):
+        # Без аргумента образ переписывается на месте исходного и журнал очищается
+        xml_path = args[0] if args else self.vfs.source_path
+        if not self.vfs.compact(xml_path):
+            self._print("Ошибка: не удалось записать образ VFS")
             return False
+        self._print(f"VFS записана в образ: {xml_path}")
+        return True
 
-        if not args:
-            print("Ошибка: укажите директорию для удаления")
+    def vfs_diff(self, args):
+        # Сравнение по хешам Меркла: "-" - есть только в текущей VFS,
+        # "+" - только в образе, "~" - изменен
+        xml_path = args[0] if args else self.vfs.source_path
+        # Сообщения загрузчика второго образа выводятся, только если он не загрузился
+        messages = []
+        other = VirtualFileSystem(use_index=False)
+        other.log = messages.append
+        if not other.load_from_xml(xml_path, mode="mmap"):
+            for message in messages:
+                self._print(message)
             return False
 
-        if len(args) > 1:
-            print("Ошибка: слишком много аргументов")
-            return False
+        changes = 0
+        for sign, path in self.vfs.diff(other):
+            self._print(f"{sign} {path}")
+            changes += 1
+        if not changes:
+            self._print("Различий нет")
+        return True
 
-        dir_path = self._normalize_path(args[0])
+    def rmdir(self, args):
+        target = self._resolve(args[0])
+        dir_path = target.path
 
         if dir_path == "/":
-            print("Ошибка: нельзя удалить корневую директорию")
+            self._print("Ошибка: нельзя удалить корневую директорию")
             return False
 
-        node = self.vfs.get_node(dir_path)
+        node = target.node
         if not node:
-            print(f"Ошибка: директория не существует: {dir_path}")
+            self._print(f"Ошибка: директория не существует: {dir_path}")
             return False
 
         if not isinstance(node, VFSFolder):
-            print(f"Ошибка: указанный путь не является директорией: {dir_path}")
+            self._print(f"Ошибка: указанный путь не является директорией: {dir_path}")
             return False
 
         if node.children:
-            print(f"Ошибка: директория не пуста: {dir_path}")
+            self._print(f"Ошибка: директория не пуста: {dir_path}")
             return False
 
-        parent_path = '/'.join(dir_path.rstrip('/').split('/')[:-1])
-        if not parent_path:
-            parent_path = "/"
-
-        parent_node = self.vfs.get_node(parent_path)
-        if not parent_node or not isinstance(parent_node, VFSFolder):
-            print("Ошибка: невозможно получить доступ к родительской директории")
+        if not isinstance(target.parent, VFSFolder):
+            self._print("Ошибка: невозможно получить доступ к родительской директории")
             return False
 
-        dir_name = dir_path.split('/')[-1]
-        if dir_name in parent_node.children:
-            del parent_node.children[dir_name]
+        if self.vfs.remove_node(target.parent, target.name):
             return True
         else:
-            print("Ошибка: не удалось удалить директорию")
+            self._print("Ошибка: не удалось удалить директорию")
             return False
 
     def cp(self, args):
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
-            return False
+        recursive = bool(args) and args[0] == '-r'
+        if recursive:
+            args = args[1:]
 
         if len(args) != 2:
-            print("Ошибка: использование: cp <источник> <назначение>")
+            self._print("Ошибка: использование: cp [-r] <источник> <назначение>")
             return False
 
-        src_path = self._normalize_path(args[0])
-        dst_path = self._normalize_path(args[1])
+        src = self._resolve(args[0])
+        dst = self._resolve(args[1])
+        src_path = src.path
+        src_node = src.node
 
-        src_node = self.vfs.get_node(src_path)
         if not src_node:
-            print(f"Ошибка: исходный файл не существует: {src_path}")
+            self._print(f"Ошибка: исходный файл не существует: {src_path}")
             return False
 
-        if not isinstance(src_node, VFSFile):
-            print(f"Ошибка: исходный путь не является файлом: {src_path}")
+        if isinstance(src_node, VFSFolder) and not recursive:
+            self._print(f"Ошибка: исходный путь не является файлом: {src_path} (для директорий используйте cp -r)")
             return False
 
-        dst_parent_path = '/'.join(dst_path.rstrip('/').split('/')[:-1])
-        if not dst_parent_path:
-            dst_parent_path = "/"
-
-        dst_name = dst_path.split('/')[-1]
-
-        dst_parent = self.vfs.get_node(dst_parent_path)
-        if not dst_parent or not isinstance(dst_parent, VFSFolder):
-            print(f"Ошибка: целевая директория не существует: {dst_parent_path}")
+        if src_path == "/":
+            self._print("Ошибка: нельзя скопировать корневую директорию")
             return False
 
-        existing_node = self.vfs.get_node(dst_path)
-        if existing_node and isinstance(existing_node, VFSFolder):
-            dst_path = dst_path.rstrip('/') + '/' + src_node.name
+        # Родитель и сам узел назначения уже найдены одним разрешением пути
+        if isinstance(dst.node, VFSFolder):
+            dst_parent = dst.node
             dst_name = src_node.name
+            dst_path = dst.path.rstrip('/') + '/' + dst_name
+        elif isinstance(dst.parent, VFSFolder):
+            dst_parent = dst.parent
+            dst_name = dst.name
+            dst_path = dst.path
+        else:
+            self._print(f"Ошибка: целевая директория не существует: {dst.parent_path}")
+            return False
 
         try:
-            new_file = VFSFile(dst_name, dst_path, src_node.content, src_node.encoding)
-            dst_parent.children[dst_name] = new_file
-            print(f"Файл скопирован: '{src_path}' -> '{dst_path}'")
+            # Содержимое не копируется: копия ссылается на те же блоки (Blob)
+            self.vfs.copy_node(src_node, dst_parent, dst_name)
+            if isinstance(src_node, VFSFolder):
+                self._print(f"Директория скопирована: '{src_path}' -> '{dst_path}'")
+            else:
+                self._print(f"Файл скопирован: '{src_path}' -> '{dst_path}'")
             return True
         except Exception as e:
-            print(f"Ошибка при копировании: {e}")
+            self._print(f"Ошибка при копировании: {e}")
             return False
 
     def cat(self, args):
         """Реализация команды cat - вывод содержимого файлов"""
-        if not self.vfs.get_info()['loaded']:
-            print("Ошибка: VFS не загружена")
-            return False
+        number_lines = False
+        files = []
+        for arg in args:
+            if arg == '-n':
+                number_lines = True
+            else:
+                files.append(arg)
 
-        if not args:
-            print("Ошибка: укажите файл для просмотра")
+        if not files:
+            self._print("Ошибка: укажите файл для просмотра")
             return False
 
-        if len(args) > 1:
-            print("Ошибка: слишком много аргументов")
-            return False
+        # Файлы выводятся подряд за один проход; при ошибке в одном из них
+        # остальные все равно выводятся, а команда завершается неудачей
+        numbering = {'line': 1, 'at_start': True} if number_lines else None
+        success = True
+        for arg in files:
+            if not self._cat_file(self._resolve(arg), numbering):
+                success = False
+
+        return success
 
-        file_path = self._normalize_path(args[0])
+    def _cat_file(self, target, numbering):
+        file_path = target.path
 
         # Получаем узел файла
-        node = self.vfs.get_node(file_path)
+        node = target.node
         if not node:
-            print(f"Ошибка: файл не существует: {file_path}")
+            self._print(f"Ошибка: файл не существует: {file_path}")
             return False
 
         if not isinstance(node, VFSFile):
-            print(f"Ошибка: указанный путь не является файлом: {file_path}")
+            self._print(f"Ошибка: указанный путь не является файлом: {file_path}")
             return False
 
-        if node.content:
-            print(node.content)
-        else:
-            print(f"Файл {file_path} пуст")
+        view = node.raw_view() if numbering is None else None
+        if view is not None:
+            # Содержимое уже лежит в образе в UTF-8: отдаем его в вывод без декодирования
+            if len(view):
+                self.out.write_bytes(view)
+                self._print()
+            else:
+                self._print(f"Файл {file_path} пуст")
+            return True
 
+        # Содержимое идет в вывод блоками, целиком в памяти оно не собирается
+        chunks = node.iter_chunks()
+        first = next(chunks, None)
+        if first is None:
+            self._print(f"Файл {file_path} пуст")
+            return True
+
+        self._cat_write(first, numbering)
+        for chunk in chunks:
+            self._cat_write(chunk, numbering)
+        if numbering is None:
+            self._print()
+        elif not numbering['at_start']:
+            # Незавершенная последняя строка файла закрывается переводом строки
+            self.out.write('\n')
+            numbering['at_start'] = True
         return True
 
-    def help(self):
-        print(" Доступные команды")
-        print("  ls [путь] - показать содержимое директории")
-        print("  cd [путь] - сменить директорию")
-        print("  cal [год] или cal [месяц] [год] - вывод календаря")
-        print("  cat [файл] - показать содержимое файла")
-        print("  uniq [файл] - фильтрация повторяющихся строк")
-        print("  uname - информация о системе")
-        print("  vfs-info - информация о загруженной VFS")
-        print("  exit - выход из эмулятора")
-        print("  help - показать эту справку")
-        print("  rmdir [директория] - удалить пустую директорию")
-        print("  cp <источник> <назначение> - копировать файл")
+    def _cat_write(self, chunk, numbering):
+        if numbering is None:
+            self.out.write(chunk)
+            return
+
+        # Нумерация в стиле cat -n: номер ставится в начале каждой строки,
+        # граница блока может приходиться на середину строки
+        parts = chunk.split('\n')
+        for part in parts[:-1]:
+            if numbering['at_start']:
+                self.out.write(f"{numbering['line']:>6}\t")
+                numbering['line'] += 1
+            self.out.write(part + '\n')
+            numbering['at_start'] = True
+        last = parts[-1]
+        if last:
+            if numbering['at_start']:
+                self.out.write(f"{numbering['line']:>6}\t")
+                numbering['line'] += 1
+            self.out.write(last)
+            numbering['at_start'] = False
+
+    def help(self, args=None):
+        self._print(" Доступные команды")
+        for command in self.commands.values():
+            if command.description:
+                self._print(f"  {command.description}")
+        return True
+
+
+def positive_int(value):
+    # Тип аргумента argparse для числа процессов: целое число не меньше 1
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"ожидается целое число не меньше 1: '{value}'")
+    return number
+
 
 def main():
     parser = argparse.ArgumentParser(description='Эмулятор командной строки')
     parser.add_argument('--vfs-path', '-v', help='Путь к XML файлу VFS')
-    parser.add_argument('--script', '-s', help='Путь к стартовому скрипту')
+    parser.add_argument('--script', '-s', help='Путь к стартовому скрипту ("-" - стандартный ввод)')
+    parser.add_argument('--vfs-mode', choices=['stream', 'lazy', 'mmap', 'tree'], default='stream',
+                        help='Режим загрузки VFS: stream - потоковый, lazy - потоковый с чтением '
+                             'содержимого файлов по требованию, mmap - как lazy, но через '
+                             'отображение образа в память, tree - через ElementTree')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='Размер LRU-кеша декодированного содержимого в режимах lazy и mmap')
+    parser.add_argument('--vfs-cache', help='Путь к двоичному снимку VFS для быстрого запуска')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Хранить одинаковое содержимое файлов VFS один раз')
+    parser.add_argument('--decode-workers', type=positive_int, default=None,
+                        help='Число процессов для декодирования base64 при загрузке VFS')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help='Не выводить приглашение перед командами скрипта')
+    parser.add_argument('--journal',
+                        help='Журнал изменений VFS: изменения дописываются в него и применяются при загрузке')
+    parser.add_argument('--grep-workers', type=positive_int, default=None,
+                        help='Число процессов для grep -r по большим поддеревьям')
+    parser.add_argument('--trigram-index', action='store_true',
+                        help='Сужать grep -r триграммным индексом содержимого (строится при первом поиске)')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Не использовать индекс путей VFS (поиск обходом дерева)')
 
     args = parser.parse_args()
 
-    shell = ShellEm(vfs_path=args.vfs_path, script_path=args.script)
+    shell = ShellEm(vfs_path=args.vfs_path, script_path=args.script, vfs_mode=args.vfs_mode,
+                    use_index=not args.no_index, cache_size=args.cache_size,
+                    snapshot_path=args.vfs_cache, dedup=args.dedup,
+                    decode_workers=args.decode_workers, quiet=args.quiet,
+                    journal_path=args.journal, grep_workers=args.grep_workers,
+                    trigram_index=args.trigram_index)
     shell.run()
 
 
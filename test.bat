@@ -1,4 +1,45 @@
 python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-stage5.txt
 python shell5.py --vfs-path vfs-xml/minimal.xml --script test/test-min.txt
 python shell5.py --vfs-path vfs-xml/deep.xml --script test/test-deep.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --vfs-mode lazy --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/deep.xml --vfs-mode lazy --script test/test-deep.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode lazy --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode lazy --cache-size 1 --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --vfs-mode mmap --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/deep.xml --vfs-mode mmap --script test/test-deep.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode mmap --script test/test-markup.txt
+if exist test\stage5.snap del test\stage5.snap
+python shell5.py --vfs-path vfs-xml/stage5.xml --vfs-cache test/stage5.snap --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --vfs-cache test/stage5.snap --script test/test-stage5.txt
+del test\stage5.snap
+if exist test\markup.snap del test\markup.snap
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode mmap --vfs-cache test/markup.snap --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode mmap --vfs-cache test/markup.snap --script test/test-markup.txt
+del test\markup.snap
+python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-uniq.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-cat.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-cp.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --dedup --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --dedup --script test/test-markup.txt
+if exist test\dedup.snap del test\dedup.snap
+python shell5.py --vfs-path vfs-xml/stage5.xml --dedup --vfs-cache test/dedup.snap --script test/test-cp.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --dedup --vfs-cache test/dedup.snap --script test/test-cp.txt
+del test\dedup.snap
+python shell5.py --vfs-path vfs-xml/stage5.xml --decode-workers 2 --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --decode-workers 2 --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode tree --decode-workers 2 --script test/test-markup.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --vfs-mode tree --script test/test-stage5.txt
+python shell5.py --vfs-path vfs-xml/deep.xml --vfs-mode tree --script test/test-deep.txt
+python shell5.py --vfs-path vfs-xml/markup.xml --vfs-mode tree --script test/test-markup.txt
+if exist test\stage5.journal del test\stage5.journal
+python shell5.py --vfs-path vfs-xml/stage5.xml --journal test/stage5.journal --script test/test-journal.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --journal test/stage5.journal --script test/test-journal-replay.txt
+if exist test\compact.journal del test\compact.journal
+python shell5.py --vfs-path test/compact.xml --vfs-mode mmap --journal test/compact.journal --script test/test-compact.txt
+del test\stage5.journal test\compact.xml test\compact.journal
+python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-find.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --script test/test-grep.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --trigram-index --script test/test-trigram.txt
+python shell5.py --vfs-path vfs-xml/stage5.xml --trigram-index --script test/test-grep.txt
 pauseq
\ No newline at end of file